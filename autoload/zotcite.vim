@@ -85,9 +85,9 @@ function zotcite#CompleteBib(findstart, base)
         endif
         let citeptrn = substitute(a:base, '^@', '', '')
         let resp = []
-        let itms = py3eval('ZotCite.GetMatch("'. citeptrn .'", "'. escape(expand("%:p"), '\\') .'")')
+        let itms = py3eval('ZotCite.GetMatch("'. citeptrn .'", "'. escape(expand("%:p"), '\\') .'", '. g:zotcite_max_results .')')
         for it in itms
-            call add(resp, {'word': it[0], 'abbr': it[1], 'menu': it[2]})
+            call add(resp, {'word': it[0], 'abbr': it[1], 'menu': '(' . it[2] . ') ' . it[3]})
         endfor
         return resp
     endif
@@ -95,21 +95,10 @@ endfunction
 
 function zotcite#getmach(key)
     let citeptrn = substitute(a:key, ' .*', '', '')
-    let refs = py3eval('ZotCite.GetMatch("'. citeptrn .'", "'. escape(expand("%:p"), '\\') .'")')
+    let refs = py3eval('ZotCite.GetMatch("'. citeptrn .'", "'. escape(expand("%:p"), '\\') .'", '. g:zotcite_max_results .')')
     let resp = []
     for ref in refs
-        let item = {'key': substitute(ref[0], '#.*', '', ''), 'author': ref[1]}
-        if ref[2] =~ '^([0-9][0-9][0-9][0-9]) '
-            let item['year'] = substitute(ref[2], '^(\([0-9][0-9][0-9][0-9]\)) .*', '\1', '')
-            let item['ttl'] = substitute(ref[2], '^([0-9][0-9][0-9][0-9]) ', '', '')
-        elseif ref[2] =~ '^() '
-            let item['year'] = ''
-            let item['ttl'] = substitute(ref[2], '^() ', '', '')
-        else
-            let item['year'] = ''
-            let item['ttl'] = ref[2]
-        endif
-        call add(resp, item)
+        call add(resp, {'key': ref[0], 'author': ref[1], 'year': ref[2], 'ttl': ref[3]})
     endfor
     if len(resp) == 0
         echo 'No matches found.'
@@ -147,6 +136,36 @@ function zotcite#Seek(key)
     call zotcite#printmatches(mtchs, 0)
 endfunction
 
+function zotcite#FullTextSearch(query)
+    let refs = py3eval('ZotCite.FullTextSearch("' . escape(a:query, '\\"') . '")')
+    let resp = []
+    for ref in refs
+        call add(resp, {'key': ref[0], 'author': ref[1], 'year': ref[2], 'ttl': ref[3]})
+    endfor
+    if len(resp) == 0
+        echo 'No matches found.'
+    endif
+    call zotcite#printmatches(resp, 0)
+endfunction
+
+function zotcite#CheckCitations()
+    py3 import vim
+    let probs = py3eval('ZotCite.CheckBuffer("' . escape(expand("%:p"), '\\') . '", vim.current.buffer[:])')
+    let items = []
+    for p in probs
+        if p[3] == 'missing'
+            let txt = 'Citation key not found: @' . p[2]
+        else
+            let txt = 'Citation key changed: @' . p[2] . ' -> @' . p[4]
+        endif
+        call add(items, {'bufnr': bufnr('%'), 'lnum': p[0], 'col': p[1], 'text': txt})
+    endfor
+    call setloclist(0, items, 'r')
+    if len(items) == 0
+        echo 'All citations were found.'
+    endif
+endfunction
+
 function zotcite#GetAnnotations(ko)
     let argmt = split(a:ko)
     let zotkey = zotcite#FindCitationKey(argmt[0])
@@ -421,9 +440,14 @@ function zotcite#GlobalInit()
 
     py3 import os
 
-    " Start ZoteroEntries
-    py3 from zotero import ZoteroEntries
-    py3 ZotCite = ZoteroEntries()
+    " Start ZoteroEntries or connect to zotcite_server.py
+    if get(g:, 'zotcite_server', 0)
+        py3 from zotcite_client import ZoteroClient
+        py3 ZotCite = ZoteroClient()
+    else
+        py3 from zotero import ZoteroEntries
+        py3 ZotCite = ZoteroEntries()
+    endif
 
     " Get information from ZoteroEntries and set environment variables for citeref
     try
@@ -441,6 +465,7 @@ function zotcite#GlobalInit()
     let g:zotcite_attach_dir = expand(info['attachments dir'])
     let g:zotcite_wait_attachment = get(g:, 'zotcite_wait_attachment', 0)
     let g:zotcite_open_in_zotero = get(g:, 'zotcite_open_in_zotero', 0)
+    let g:zotcite_max_results = get(g:, 'zotcite_max_results', 0)
 
     call zotcite#SetPath()
     let $RmdFile = expand("%:p")
@@ -460,9 +485,11 @@ function zotcite#GlobalInit()
     unlet s:uname
 
     command -nargs=1 Zseek call zotcite#Seek(<q-args>)
+    command -nargs=1 Zsearch call zotcite#FullTextSearch(<q-args>)
     command -nargs=1 Znote call zotcite#GetNote(<q-args>)
     command -nargs=+ Zannotations call zotcite#GetAnnotations(<q-args>)
     command -nargs=1 Zpdfnote call zotcite#GetPDFNote(<q-args>)
+    command Zcheck call zotcite#CheckCitations()
     return 1
 endfunction
 
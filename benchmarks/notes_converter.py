@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""
+Compare the time spent converting Zotero notes into markdown by
+html2markdown() and by pandoc.
+
+Usage: notes_converter.py [number_of_notes]
+"""
+
+import os
+import sys
+import time
+import shutil
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "python3"))
+from html2markdown import html2markdown
+
+NOTE = (
+    '<div data-schema-version="8"><h1>Reading notes {n}</h1>'
+    "<p>The <strong>main</strong> argument is <em>not</em> new, but the "
+    '<u>data</u> and the <span style="text-decoration: line-through">old'
+    '</span> <span class="highlight" data-annotation="%7B%22n%22%3A{n}%7D">'
+    "highlighted passage</span> are.</p>"
+    "<ul><li><p>First point</p></li><li><p>Second point with a "
+    '<a href="https://example.org/{n}">link</a></p></li></ul>'
+    "<blockquote><p>A quotation, p. {n}</p></blockquote></div>"
+)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    notes = [NOTE.format(n=i) for i in range(n)]
+
+    t = time.perf_counter()
+    for note in notes:
+        html2markdown(note)
+    builtin = time.perf_counter() - t
+    print(
+        f"html2markdown: {n} notes in {builtin:.4f} s ({builtin / n * 1000:.3f} ms/note)"
+    )
+
+    if shutil.which("pandoc") is None:
+        print("pandoc: not found")
+        return
+    t = time.perf_counter()
+    for note in notes:
+        subprocess.run(
+            ["pandoc", "-f", "html", "-t", "markdown"],
+            input=note.encode("utf-8"),
+            stdout=subprocess.PIPE,
+            check=True,
+        )
+    pandoc = time.perf_counter() - t
+    print(
+        f"pandoc:        {n} notes in {pandoc:.4f} s ({pandoc / n * 1000:.3f} ms/note)"
+    )
+    print(f"speedup:       {pandoc / builtin:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+"""
+Compare the time spent by pdfnotes.py extracting the highlighted texts of a
+heavily annotated PDF with one page.text() call for each line of each
+highlight and with one page.textList() call for each page.
+
+Usage: pdf_annotations.py [pages [highlights_per_page]]
+
+The PDF is created in the system's temporary directory. Only the even pages
+have annotations.
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "python3"))
+import pdfnotes
+
+WORDS = (
+    "the of and climate policy inter- national market change data model "
+    "analysis effect growth public social theory evidence between results"
+).split()
+
+# Courier is monospaced: at 10 pt, each character is 6 pt wide.
+SIZE = 10
+CHAR = 6
+LEADING = 12
+LEFT = 72
+TOP = 720
+LINES = 54
+COLUMNS = 80
+
+
+def _page(r, highlights):
+    """Return the content stream and the annotations of a page"""
+    lines = []
+    for _ in range(LINES):
+        line = []
+        while len(" ".join(line + [WORDS[0]])) < COLUMNS:
+            line.append(r.choice(WORDS))
+        lines.append(line)
+
+    content = [f"BT /F1 {SIZE} Tf {LEADING} TL {LEFT} {TOP} Td"]
+    for line in lines:
+        content.append("(" + " ".join(line) + ") Tj T*")
+    content.append("ET")
+
+    annots = []
+    for _ in range(highlights):
+        first = r.randrange(LINES - 4)
+        nlines = r.randint(1, 4)
+        quads = []
+        for j in range(nlines):
+            words = lines[first + j]
+            start = r.randrange(len(words)) if j == 0 else 0
+            end = r.randint(start + 1, len(words)) if j == nlines - 1 else len(words)
+            x1 = LEFT + len(" ".join(words[:start] + [""])) * CHAR if start else LEFT
+            x2 = LEFT + len(" ".join(words[:end])) * CHAR
+            y = TOP - (first + j) * LEADING
+            quads += [x1, y + 9, x2, y + 9, x1, y - 3, x2, y - 3]
+        xs = quads[0::2]
+        ys = quads[1::2]
+        rect = [min(xs), min(ys), max(xs), max(ys)]
+        comment = "(A comment)" if r.random() < 0.3 else "()"
+        annots.append(
+            "<< /Type /Annot /Subtype /Highlight /F 4 /C [1 1 0] /T (Reader)"
+            f" /Contents {comment}"
+            f" /Rect [{' '.join(map(str, rect))}]"
+            f" /QuadPoints [{' '.join(map(str, quads))}] >>"
+        )
+    return "\n".join(content), annots
+
+
+def make_pdf(path, pages, highlights, seed=1):
+    """Write a PDF with pages of text in Courier and highlight annotations"""
+    r = random.Random(seed)
+    objects = [None, None, "<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>"]
+    kids = []
+    for p in range(pages):
+        content, annots = _page(r, highlights if p % 2 == 1 else 0)
+        refs = []
+        for a in annots:
+            objects.append(a)
+            refs.append(f"{len(objects)} 0 R")
+        data = content.encode("latin-1")
+        objects.append(f"<< /Length {len(data)} >>\nstream\n" + content + "\nendstream")
+        content_ref = len(objects)
+        objects.append(
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792]"
+            " /Resources << /Font << /F1 3 0 R >> >>"
+            f" /Contents {content_ref} 0 R /Annots [{' '.join(refs)}] >>"
+        )
+        kids.append(f"{len(objects)} 0 R")
+    objects[0] = "<< /Type /Catalog /Pages 2 0 R >>"
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(len(out))
+        out += f"{i + 1} 0 obj\n{obj}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    for off in offsets:
+        out += f"{off:010d} 00000 n \n".encode("latin-1")
+    out += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+        f"startxref\n{xref}\n%%EOF\n"
+    ).encode("latin-1")
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    highlights = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    path = os.path.join(
+        tempfile.gettempdir(), f"zotcite_benchmark_{pages}_{highlights}.pdf"
+    )
+    make_pdf(path, pages, highlights)
+
+    t = time.perf_counter()
+    by_quad = pdfnotes._extract_pages(path, "", 0, None, textlist=False)[0]
+    slow = time.perf_counter() - t
+    t = time.perf_counter()
+    by_page = pdfnotes._extract_pages(path, "", 0, None, textlist=True)[0]
+    fast = time.perf_counter() - t
+
+    n = len(by_page)
+    print(f"{pages} pages, {highlights} highlights on every other page")
+    print(f"page.text():     {slow:.4f} s ({slow / max(n, 1) * 1000:.3f} ms/note)")
+    print(f"page.textList(): {fast:.4f} s ({fast / max(n, 1) * 1000:.3f} ms/note)")
+    print(f"speedup:         {slow / fast:.1f}x")
+    if by_quad != by_page:
+        print("The extracted texts differ:")
+        for a, b in zip(by_quad, by_page):
+            if a != b:
+                print(f"  page {a[0]}: {a[4]!r}\n          {b[4]!r}")
+
+
+if __name__ == "__main__":
+    main()
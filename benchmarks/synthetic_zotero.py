@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+
+"""
+Create synthetic zotero.sqlite and better-bibtex.sqlite files with the
+tables read by ZoteroEntries, so that zotcite can be benchmarked without a
+real Zotero library.
+
+Usage: synthetic_zotero.py directory number_of_references [seed]
+"""
+
+import os
+import sys
+import random
+import datetime
+import sqlite3
+
+# Only the tables and columns used by zotcite, with Zotero's names
+SCHEMA = """
+CREATE TABLE itemTypes (itemTypeID INTEGER PRIMARY KEY, typeName TEXT);
+CREATE TABLE fields (fieldID INTEGER PRIMARY KEY, fieldName TEXT);
+CREATE TABLE items (
+    itemID INTEGER PRIMARY KEY, itemTypeID INT, dateAdded TEXT,
+    dateModified TEXT, clientDateModified TEXT, libraryID INT,
+    key TEXT UNIQUE, version INT DEFAULT 0, synced INT DEFAULT 0
+);
+CREATE TABLE itemDataValues (valueID INTEGER PRIMARY KEY, value UNIQUE);
+CREATE TABLE itemData (
+    itemID INT, fieldID INT, valueID INT, PRIMARY KEY (itemID, fieldID)
+);
+CREATE TABLE creators (
+    creatorID INTEGER PRIMARY KEY, firstName TEXT, lastName TEXT, fieldMode INT
+);
+CREATE TABLE creatorTypes (creatorTypeID INTEGER PRIMARY KEY, creatorType TEXT);
+CREATE TABLE itemCreators (
+    itemID INT, creatorID INT, creatorTypeID INT, orderIndex INT,
+    PRIMARY KEY (itemID, orderIndex)
+);
+CREATE TABLE itemAttachments (
+    itemID INTEGER PRIMARY KEY, parentItemID INT, linkMode INT,
+    contentType TEXT, path TEXT
+);
+CREATE TABLE itemAnnotations (
+    itemID INTEGER PRIMARY KEY, parentItemID INT NOT NULL, type INT NOT NULL,
+    authorName TEXT, text TEXT, comment TEXT, color TEXT, pageLabel TEXT,
+    sortIndex TEXT, position TEXT, isExternal INT
+);
+CREATE TABLE itemNotes (
+    itemID INTEGER PRIMARY KEY, parentItemID INT, note TEXT, title TEXT
+);
+CREATE TABLE collections (
+    collectionID INTEGER PRIMARY KEY, collectionName TEXT,
+    parentCollectionID INT DEFAULT NULL, clientDateModified TEXT,
+    libraryID INT, key TEXT
+);
+CREATE TABLE collectionItems (
+    collectionID INT, itemID INT, orderIndex INT DEFAULT 0,
+    PRIMARY KEY (collectionID, itemID)
+);
+CREATE TABLE deletedItems (
+    itemID INTEGER PRIMARY KEY, dateDeleted DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+CREATE TABLE tags (tagID INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE itemTags (
+    itemID INT NOT NULL, tagID INT NOT NULL, type INT NOT NULL,
+    PRIMARY KEY (itemID, tagID)
+);
+CREATE INDEX itemAttachments_parentItemID ON itemAttachments(parentItemID);
+CREATE INDEX itemAnnotations_parentItemID ON itemAnnotations(parentItemID);
+CREATE INDEX itemNotes_parentItemID ON itemNotes(parentItemID);
+CREATE INDEX collectionItems_itemID ON collectionItems(itemID);
+"""
+
+ITEM_TYPES = [
+    "journalArticle",
+    "book",
+    "bookSection",
+    "report",
+    "thesis",
+    "attachment",
+    "note",
+    "annotation",
+]
+FIELDS = [
+    "title",
+    "date",
+    "issueDate",
+    "publicationTitle",
+    "abstractNote",
+    "pages",
+    "volume",
+    "publisher",
+    "DOI",
+]
+CREATOR_TYPES = ["author", "editor", "translator", "seriesEditor"]
+
+WORDS = (
+    "theory social capital analysis data model history neural bayesian "
+    "inference market state power language class labour culture network "
+    "learning evolution memory policy health climate urban migration law "
+    "religion gender media trade energy"
+).split()
+LAST_NAMES = (
+    "Smith Marx Weber Durkheim Bourdieu Silva Müller Tanaka Garcia Nguyen "
+    "Ivanova Okafor Rossi Kowalski Dubois Jensen Haddad Kim Santos Cohen"
+).split()
+FIRST_NAMES = "Ana John Karl Max Pierre Yuki Maria Chen Olga Ngozi Luca Eva".split()
+
+NOTE = (
+    '<div data-schema-version="8"><h1>Notes on {word}</h1>'
+    "<p>The <strong>{word}</strong> argument is <em>not</em> new "
+    '<span class="citation" data-citation="%7B%22citationItems%22%3A%5B%7B'
+    "%22uris%22%3A%5B%22http%3A%2F%2Fzotero.org%2Fusers%2Flocal%2Fabc"
+    '%2Fitems%2F{ref}%22%5D%7D%5D%7D">(<span class="citation-item">X</span>)'
+    "</span>.</p><ul><li><p>First point</p></li><li><p>Second point with a "
+    '<a href="https://example.org/{n}">link</a></p></li></ul></div>'
+)
+
+DATE = "2020-01-01 00:00:00"
+# Items are added one minute apart and last modified later, at distinct times
+START = datetime.datetime(2020, 1, 1)
+
+
+def _dates(item_id):
+    """Return the dateAdded and dateModified of an item"""
+    added = START + datetime.timedelta(minutes=item_id)
+    modified = START + datetime.timedelta(minutes=2 * item_id, seconds=30)
+    return str(added), str(modified)
+
+
+def _key(r, used):
+    """Return a new random Zotero key"""
+    while True:
+        k = "".join(r.choices("ABCDEFGHIJKLMNPQRSTUVWXYZ23456789", k=8))
+        if k not in used:
+            used.add(k)
+            return k
+
+
+def _words(r, n):
+    return " ".join(r.choice(WORDS) for _ in range(n))
+
+
+def generate(directory, n, seed=1):
+    """Create zotero.sqlite and better-bibtex.sqlite in directory
+
+    directory (string): Where the files are written (replacing old ones).
+    n            (int): Number of references. Attachments, annotations and
+                        notes are added to some of them.
+    seed         (int): Seed of the random generator.
+
+    Return the paths of zotero.sqlite and better-bibtex.sqlite.
+    """
+
+    r = random.Random(seed)
+    zpath = os.path.join(directory, "zotero.sqlite")
+    bpath = os.path.join(directory, "better-bibtex.sqlite")
+    for path in (zpath, bpath):
+        if os.path.exists(path):
+            os.remove(path)
+
+    itype = {t: i for i, t in enumerate(ITEM_TYPES, 1)}
+    field = {f: i for i, f in enumerate(FIELDS, 1)}
+    ctype = {c: i for i, c in enumerate(CREATOR_TYPES, 1)}
+    ref_types = [itype["journalArticle"]] * 6 + [
+        itype["book"],
+        itype["bookSection"],
+        itype["report"],
+        itype["thesis"],
+    ]
+
+    # Zotero stores each distinct value and creator only once
+    values = {}
+    creators = {}
+
+    def value(v):
+        if v not in values:
+            values[v] = len(values) + 1
+        return values[v]
+
+    def creator(first, last):
+        if (first, last) not in creators:
+            creators[(first, last)] = len(creators) + 1
+        return creators[(first, last)]
+
+    items = []
+    item_data = []
+    item_creators = []
+    attachments = []
+    annotations = []
+    notes = []
+    citekeys = []
+    references = []
+    item_id = 0
+    used_keys = set()
+    used_citekeys = set()
+
+    def new_item(type_id):
+        nonlocal item_id
+        item_id += 1
+        added, modified = _dates(item_id)
+        items.append(
+            (item_id, type_id, added, modified, modified, 1, _key(r, used_keys))
+        )
+        return item_id, items[-1][6]
+
+    for _ in range(n):
+        ref_id, ref_key = new_item(r.choice(ref_types))
+        references.append((ref_id, ref_key))
+        title = _words(r, r.randint(3, 10)).capitalize()
+        year = r.randint(1850, 2024)
+        data = {
+            "title": title,
+            "publicationTitle": "Journal of " + r.choice(WORDS),
+            "abstractNote": _words(r, r.randint(10, 60)),
+            "pages": f"{r.randint(1, 200)}-{r.randint(201, 400)}",
+            "volume": str(r.randint(1, 80)),
+            "DOI": f"10.{r.randint(1000, 9999)}/{ref_key.lower()}",
+        }
+        if r.random() < 0.05:
+            data["issueDate"] = f"{year}-03-01 {year}-03-01"
+        else:
+            data["date"] = f"{year}-01-01 {year}"
+        if r.random() < 0.3:
+            data["publisher"] = r.choice(LAST_NAMES) + " Press"
+        for f, v in data.items():
+            item_data.append((ref_id, field[f], value(v)))
+
+        # Most references have authors, a few only editors or translators
+        kind = "author" if r.random() < 0.9 else r.choice(CREATOR_TYPES[1:])
+        names = [r.choice(LAST_NAMES) for _ in range(r.randint(1, 4))]
+        for order, last in enumerate(names):
+            c = creator(r.choice(FIRST_NAMES), last)
+            item_creators.append((ref_id, c, ctype[kind], order))
+
+        # Similar to Better BibTeX's default citation keys, made unique
+        base = names[0].lower() + str(year) + title.split()[0].lower()
+        citekey = base
+        suffix = 0
+        while citekey in used_citekeys:
+            suffix += 1
+            citekey = base + "-" + str(suffix)
+        used_citekeys.add(citekey)
+        citekeys.append((ref_id, ref_key, 1, citekey))
+
+        if r.random() < 0.5:
+            att_id, _ = new_item(itype["attachment"])
+            attachments.append(
+                (att_id, ref_id, 0, "application/pdf", "storage:" + ref_key + ".pdf")
+            )
+            for _ in range(r.randint(0, 6)):
+                ann_id, _ = new_item(itype["annotation"])
+                annotations.append(
+                    (
+                        ann_id,
+                        att_id,
+                        1,
+                        "",
+                        "highlight " + _words(r, r.randint(3, 15)),
+                        r.choice(["", "", "comment " + _words(r, 5)]),
+                        "#ffd400",
+                        str(r.randint(1, 300)),
+                        "",
+                        None,
+                        0,
+                    )
+                )
+        if r.random() < 0.3:
+            note_id, _ = new_item(itype["note"])
+            cited = r.choice(references)[1]
+            notes.append(
+                (
+                    note_id,
+                    ref_id,
+                    NOTE.format(word=r.choice(WORDS), ref=cited, n=note_id),
+                    "",
+                )
+            )
+
+    conn = sqlite3.connect(zpath)
+    conn.executescript(SCHEMA)
+    conn.executemany("INSERT INTO itemTypes VALUES (?, ?)", enumerate(ITEM_TYPES, 1))
+    conn.executemany("INSERT INTO fields VALUES (?, ?)", enumerate(FIELDS, 1))
+    conn.executemany(
+        "INSERT INTO creatorTypes VALUES (?, ?)", enumerate(CREATOR_TYPES, 1)
+    )
+    conn.executemany("INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?, 0, 0)", items)
+    conn.executemany(
+        "INSERT INTO itemDataValues VALUES (?, ?)", [(i, v) for v, i in values.items()]
+    )
+    conn.executemany("INSERT INTO itemData VALUES (?, ?, ?)", item_data)
+    conn.executemany(
+        "INSERT INTO creators VALUES (?, ?, ?, 0)",
+        [(i, first, last) for (first, last), i in creators.items()],
+    )
+    conn.executemany("INSERT INTO itemCreators VALUES (?, ?, ?, ?)", item_creators)
+    conn.executemany("INSERT INTO itemAttachments VALUES (?, ?, ?, ?, ?)", attachments)
+    conn.executemany(
+        "INSERT INTO itemAnnotations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        annotations,
+    )
+    conn.executemany("INSERT INTO itemNotes VALUES (?, ?, ?, ?)", notes)
+
+    # A tree of collections: the first ones are at the top level
+    ncollections = max(3, n // 500)
+    conn.executemany(
+        "INSERT INTO collections VALUES (?, ?, ?, ?, 1, ?)",
+        [
+            (
+                i,
+                "Collection " + str(i),
+                None if i <= 3 else r.randint(1, i - 1),
+                DATE,
+                _key(r, used_keys),
+            )
+            for i in range(1, ncollections + 1)
+        ],
+    )
+    conn.executemany(
+        "INSERT INTO collectionItems VALUES (?, ?, 0)",
+        [
+            (c, ref_id)
+            for ref_id, _ in references
+            for c in r.sample(range(1, ncollections + 1), r.randint(0, 2))
+        ],
+    )
+    conn.executemany(
+        "INSERT INTO deletedItems (itemID) VALUES (?)",
+        [(ref_id,) for ref_id, _ in r.sample(references, max(1, n // 100))],
+    )
+    # Tagged last, so that the rest of the library does not depend on it
+    conn.executemany("INSERT INTO tags VALUES (?, ?)", enumerate(WORDS, 1))
+    conn.executemany(
+        "INSERT INTO itemTags VALUES (?, ?, 0)",
+        [
+            (ref_id, t)
+            for ref_id, _ in references
+            for t in r.sample(range(1, len(WORDS) + 1), r.randint(0, 3))
+        ],
+    )
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(bpath)
+    conn.execute(
+        """
+        CREATE TABLE citationkey (
+            itemID INTEGER PRIMARY KEY, itemKey TEXT, libraryID INT,
+            citationKey TEXT, pinned INT DEFAULT 0
+        )
+        """
+    )
+    conn.executemany("INSERT INTO citationkey VALUES (?, ?, ?, ?, 0)", citekeys)
+    conn.commit()
+    conn.close()
+    return zpath, bpath
+
+
+def main():
+    if len(sys.argv) < 3:
+        sys.stderr.write(__doc__.strip().splitlines()[-1] + "\n")
+        sys.exit(1)
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    os.makedirs(sys.argv[1], exist_ok=True)
+    generate(sys.argv[1], int(sys.argv[2]), seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+"""
+Time the methods of ZoteroEntries on synthetic Zotero libraries of
+different sizes.
+
+Usage: zotero_entries.py [--sizes 1000,10000,...] [--calls N] [--memory]
+                         [--data-dir DIR] [--output FILE] [--compare FILE]
+
+The databases are created by synthetic_zotero.py in DIR (a directory in the
+system's temporary directory by default) and reused by later runs. The
+results are written as JSON to FILE (or to the standard output) and a
+summary is written to the standard error. With --compare, the median times
+are compared with the ones of a previous run.
+
+Other variables that customize zotcite, such as $Zotcite_copy_method, are
+respected, so that their effect can be measured.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "python3"))
+sys.path.insert(0, HERE)
+from synthetic_zotero import generate
+from zotero import ZoteroEntries
+
+
+def _stats(times):
+    """Summarize a list of durations in seconds, in milliseconds"""
+    times = sorted(times)
+    n = len(times)
+    return {
+        "calls": n,
+        "mean_ms": sum(times) / n * 1000,
+        "p50_ms": times[n // 2] * 1000,
+        "p95_ms": times[min(n - 1, int(n * 0.95))] * 1000,
+        "min_ms": times[0] * 1000,
+        "max_ms": times[-1] * 1000,
+    }
+
+
+def _time_calls(func, args_list):
+    times = []
+    for args in args_list:
+        t = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - t)
+    return _stats(times)
+
+
+def _database(data_dir, size):
+    directory = os.path.join(data_dir, str(size))
+    zpath = os.path.join(directory, "zotero.sqlite")
+    bpath = os.path.join(directory, "better-bibtex.sqlite")
+    if not (os.path.isfile(zpath) and os.path.isfile(bpath)):
+        sys.stderr.write(f"Creating a library with {size} references...\n")
+        os.makedirs(directory, exist_ok=True)
+        generate(directory, size)
+    return zpath, bpath
+
+
+def _sample(zpath, bpath, calls):
+    """Return random Zotero keys, citation keys and titles of the library"""
+    conn = sqlite3.connect(zpath)
+    conn.execute("ATTACH DATABASE ? AS betterbibtex", (bpath,))
+    rows = conn.execute(
+        """
+        SELECT betterbibtex.citationkey.itemKey,
+            betterbibtex.citationkey.citationKey, itemDataValues.value
+        FROM betterbibtex.citationkey, items, itemData, fields, itemDataValues
+        WHERE
+            items.key = betterbibtex.citationkey.itemKey
+            and itemData.itemID = items.itemID
+            and itemData.fieldID = fields.fieldID
+            and fields.fieldName = 'title'
+            and itemData.valueID = itemDataValues.valueID
+        """
+    ).fetchall()
+    conn.close()
+    r = random.Random(1)
+    return [r.choice(rows) for _ in range(calls)]
+
+
+def _edit_titles(zpath, n):
+    """Change the titles of n random references, as Zotero does"""
+    conn = sqlite3.connect(zpath)
+    ids = conn.execute(
+        """
+        SELECT itemData.itemID, itemData.valueID
+        FROM itemData, fields
+        WHERE itemData.fieldID = fields.fieldID and fields.fieldName = 'title'
+        """
+    ).fetchall()
+    now = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    for item_id, value_id in random.Random(n).sample(ids, n):
+        conn.execute(
+            "UPDATE itemDataValues SET value = value || ' (edited)' WHERE valueID = ?",
+            (value_id,),
+        )
+        conn.execute(
+            "UPDATE items SET dateModified = ?, clientDateModified = ?"
+            " WHERE itemID = ?",
+            (now, now, item_id),
+        )
+    conn.commit()
+    conn.close()
+    # Make sure the copy of the database is refreshed
+    t = time.time() + 1
+    os.utime(zpath, (t, t))
+
+
+def run(size, args):
+    zpath, bpath = _database(args.data_dir, size)
+    tmpdir = os.path.join(args.data_dir, str(size), "tmp")
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.mkdir(tmpdir)
+    os.environ["ZoteroSQLpath"] = zpath
+    os.environ["BetterBibtexSQLpath"] = bpath
+    os.environ["Zotcite_tmpdir"] = tmpdir
+
+    results = []
+
+    def add(benchmark, param, stats):
+        results.append(dict(size=size, benchmark=benchmark, param=param, **stats))
+
+    if args.memory:
+        tracemalloc.start()
+    t = time.perf_counter()
+    z = ZoteroEntries()
+    add("__init__", "no cache", _stats([time.perf_counter() - t]))
+    if args.memory:
+        memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[-1]["memory_mb"] = memory[0] / 2**20
+        results[-1]["peak_memory_mb"] = memory[1] / 2**20
+    del z
+
+    t = time.perf_counter()
+    z = ZoteroEntries()
+    add("__init__", "cache", _stats([time.perf_counter() - t]))
+
+    sample = _sample(zpath, bpath, args.calls)
+    r = random.Random(2)
+    for length in range(1, 9):
+        # Citation key prefixes and pieces of titles
+        patterns = []
+        for i, (_, citekey, title) in enumerate(sample):
+            if i % 2 == 0:
+                patterns.append(citekey[:length])
+            else:
+                start = r.randint(0, max(0, len(title) - length))
+                patterns.append(title[start : start + length])
+        add(
+            "GetMatch",
+            f"length {length}",
+            _time_calls(z.GetMatch, [(p, "doc.md") for p in patterns]),
+        )
+
+    keys = [(zotkey,) for zotkey, _, _ in sample]
+    add("GetRefData", "", _time_calls(z.GetRefData, keys))
+    add("GetAttachment", "", _time_calls(z.GetAttachment, keys))
+    add("GetAnnotations", "", _time_calls(z.GetAnnotations, [k + (0,) for k in keys]))
+    add("GetNotes", "", _time_calls(z.GetNotes, keys))
+
+    # Reloads after Zotero changed the titles of one item and of a tenth of
+    # the references, as in a bulk sync
+    for param, n in (("1 changed", 1), ("10% changed", max(1, size // 10))):
+        _edit_titles(zpath, n)
+        t = time.perf_counter()
+        z._refresh_zotero_data()
+        add("reload", param, _stats([time.perf_counter() - t]))
+    t = time.perf_counter()
+    z._load_zotero_data()
+    add("reload", "full", _stats([time.perf_counter() - t]))
+    return results
+
+
+def _summary(results, previous):
+    old = {}
+    for res in previous:
+        old[(res["size"], res["benchmark"], res["param"])] = res["p50_ms"]
+    for res in results:
+        line = "{:>7} {:<15} {:<10} {:>5} calls  p50 {:>9.3f} ms  p95 {:>9.3f} ms"
+        line = line.format(
+            res["size"],
+            res["benchmark"],
+            res["param"],
+            res["calls"],
+            res["p50_ms"],
+            res["p95_ms"],
+        )
+        if "memory_mb" in res:
+            line += "  {:.1f} MB".format(res["memory_mb"])
+        key = (res["size"], res["benchmark"], res["param"])
+        if key in old and old[key] > 0:
+            line += "  ({:.2f}x)".format(res["p50_ms"] / old[key])
+        sys.stderr.write(line + "\n")
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=HERE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ZoteroEntries")
+    parser.add_argument(
+        "--sizes",
+        default="1000,10000,50000",
+        help="comma separated numbers of references (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--calls",
+        type=int,
+        default=200,
+        help="calls of each method for each size (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="measure the memory allocated by __init__ with tracemalloc",
+    )
+    parser.add_argument(
+        "--data-dir",
+        default=os.path.join(tempfile.gettempdir(), "zotcite_benchmarks"),
+        help="where the synthetic libraries are stored",
+    )
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--compare", help="JSON file of a previous run")
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        results += run(size, args)
+
+    previous = []
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["results"]
+    _summary(results, previous)
+
+    report = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "calls": args.calls,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+""" Convert the HTML of Zotero notes into pandoc's markdown """
+import re
+from html.parser import HTMLParser
+
+# Zotero's note editor only produces a small subset of HTML. It is converted
+# here into the markdown that "pandoc -f html -t markdown" would output
+# (except that lines are not wrapped), so that notes can be inserted without
+# starting a pandoc process. Anything else raises UnsupportedHTML and the
+# caller should fall back to pandoc.
+
+
+class UnsupportedHTML(Exception):
+    """The HTML has elements that are not converted by html2markdown()"""
+
+
+_inline_tags = {
+    "a",
+    "b",
+    "br",
+    "code",
+    "del",
+    "em",
+    "i",
+    "s",
+    "span",
+    "strike",
+    "strong",
+    "sub",
+    "sup",
+    "u",
+}
+_block_tags = {
+    "blockquote",
+    "div",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "hr",
+    "li",
+    "ol",
+    "p",
+    "pre",
+    "ul",
+}
+_void_tags = {"br", "hr"}
+
+
+class _Node:
+    __slots__ = ("tag", "attrs", "children")
+
+    def __init__(self, tag, attrs):
+        self.tag = tag
+        self.attrs = attrs
+        self.children = []
+
+
+class _TreeBuilder(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.root = _Node("div", [])
+        self._stack = [self.root]
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in _inline_tags and tag not in _block_tags:
+            raise UnsupportedHTML(tag)
+        node = _Node(tag, attrs)
+        self._stack[-1].children.append(node)
+        if tag not in _void_tags:
+            self._stack.append(node)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in _void_tags:
+            self._stack.pop()
+
+    def handle_endtag(self, tag):
+        if tag in _void_tags:
+            return
+        # Close the element and any unclosed element inside it
+        for i in range(len(self._stack) - 1, 0, -1):
+            if self._stack[i].tag == tag:
+                del self._stack[i:]
+                return
+
+    def handle_data(self, data):
+        self._stack[-1].children.append(data)
+
+
+def _escape(text):
+    text = re.sub(r"([\\*`\[\]<>@$~^|])", r"\\\1", text)
+    # Underscores inside words do not need to be escaped
+    return re.sub(r"(?<![0-9A-Za-z])_|_(?![0-9A-Za-z])", r"\\_", text)
+
+
+def _escape_line_start(line):
+    # Avoid that the beginning of a paragraph is read as a heading or a list
+    if re.match(r"#|[-+] |[0-9]+[.)] ", line):
+        if line[0] in "#-+":
+            return "\\" + line
+        return re.sub(r"^([0-9]+)([.)])", r"\1\\\2", line)
+    return line
+
+
+def _span_attrs(attrs):
+    ids = []
+    classes = []
+    others = []
+    for k, v in attrs:
+        if v is None:
+            v = ""
+        if k == "id":
+            ids.append("#" + v)
+        elif k == "class":
+            classes += ["." + c for c in v.split()]
+        else:
+            if k.startswith("data-"):
+                k = k[5:]
+            others.append(k + '="' + v.replace('"', '\\"') + '"')
+    return " ".join(ids + classes + others)
+
+
+def _wrap(content, marker):
+    """Put the marker around the content, leaving its outer spaces outside,
+    since "** text **" is not emphasized"""
+    core = content.strip(" ")
+    start = content.index(core)
+    return content[:start] + marker + core + marker + content[start + len(core) :]
+
+
+def _inline(nodes):
+    out = []
+    for node in nodes:
+        if isinstance(node, str):
+            out.append(_escape(re.sub(r"\s+", " ", node)))
+            continue
+        if node.tag in _block_tags:
+            raise UnsupportedHTML(node.tag)
+        tag = node.tag
+        if tag == "br":
+            out.append("\\\n")
+            continue
+        if tag == "code":
+            out.append("`" + "".join(_text(node.children)) + "`")
+            continue
+        content = _inline(node.children)
+        if content.strip() == "":
+            out.append(content)
+        elif tag in ("strong", "b"):
+            out.append(_wrap(content, "**"))
+        elif tag in ("em", "i"):
+            out.append(_wrap(content, "*"))
+        elif tag == "u":
+            out.append("[" + content + "]{.underline}")
+        elif tag in ("s", "strike", "del"):
+            out.append(_wrap(content, "~~"))
+        elif tag == "sup":
+            out.append(_wrap(content, "^"))
+        elif tag == "sub":
+            out.append(_wrap(content, "~"))
+        elif tag == "a":
+            attrs = dict(node.attrs)
+            href = attrs.get("href") or ""
+            if content == _escape(href) and re.match("[a-z]+:", href):
+                out.append("<" + href + ">")
+            elif attrs.get("title"):
+                out.append("[" + content + "](" + href + ' "' + attrs["title"] + '")')
+            else:
+                out.append("[" + content + "](" + href + ")")
+        else:  # span
+            attrs = _span_attrs(node.attrs)
+            if attrs:
+                out.append("[" + content + "]{" + attrs + "}")
+            else:
+                out.append(content)
+    # The spaces moved out of the markers might be next to other spaces
+    for i in range(1, len(out)):
+        if out[i].startswith(" ") and out[i - 1].endswith(" "):
+            out[i] = out[i][1:]
+    return "".join(out)
+
+
+def _text(nodes):
+    for node in nodes:
+        if isinstance(node, str):
+            yield node
+        else:
+            yield from _text(node.children)
+
+
+def _paragraph(nodes):
+    text = _inline(nodes).strip(" ")
+    lines = [line.strip(" ") for line in text.split("\n")]
+    if lines:
+        lines[0] = _escape_line_start(lines[0])
+    return "\n".join(lines).strip("\n")
+
+
+def _indent(block, first, rest):
+    lines = block.split("\n")
+    return "\n".join(
+        [first + lines[0]] + [(rest + line if line else "") for line in lines[1:]]
+    )
+
+
+def _blocks(nodes):
+    """Return a list of markdown blocks"""
+    blocks = []
+    inline = []
+
+    def flush():
+        if inline:
+            p = _paragraph(inline)
+            if p:
+                blocks.append(p)
+            inline.clear()
+
+    for node in nodes:
+        if isinstance(node, str) or node.tag in _inline_tags:
+            inline.append(node)
+            continue
+        flush()
+        tag = node.tag
+        if tag == "p":
+            p = _paragraph(node.children)
+            if p:
+                blocks.append(p)
+        elif tag in ("h1", "h2", "h3", "h4", "h5", "h6"):
+            h = _paragraph(node.children)
+            if h:
+                blocks.append("#" * int(tag[1]) + " " + h)
+        elif tag == "div":
+            blocks += _blocks(node.children)
+        elif tag == "blockquote":
+            quote = "\n\n".join(_blocks(node.children))
+            if quote:
+                blocks.append(_indent(quote, "> ", "> ").replace("\n\n", "\n>\n"))
+        elif tag == "pre":
+            code = "".join(_text(node.children)).strip("\n")
+            blocks.append(_indent(code, "    ", "    "))
+        elif tag == "hr":
+            blocks.append("-" * 72)
+        elif tag in ("ul", "ol"):
+            blocks.append(_list(node))
+        else:  # li outside of a list
+            raise UnsupportedHTML(tag)
+    flush()
+    return blocks
+
+
+def _list(node):
+    items = [n for n in node.children if not isinstance(n, str)]
+    if any(n.tag != "li" for n in items):
+        raise UnsupportedHTML(node.tag)
+    # Items with paragraphs are separated by blank lines
+    loose = any(
+        not isinstance(c, str) and c.tag == "p" for n in items for c in n.children
+    )
+    start = 1
+    if node.tag == "ol":
+        try:
+            start = int(dict(node.attrs).get("start") or 1)
+        except ValueError:
+            raise UnsupportedHTML("ol start")
+    out = []
+    for i, item in enumerate(items):
+        if node.tag == "ul":
+            marker = "-   "
+        else:
+            marker = (str(start + i) + ".").ljust(4)
+        content = ("\n\n" if loose else "\n").join(_blocks(item.children))
+        out.append(_indent(content, marker, " " * len(marker)))
+    return ("\n\n" if loose else "\n").join(out)
+
+
+def html2markdown(html):
+    """Convert the HTML of a Zotero note into markdown.
+
+    html (string): The note, as stored in Zotero's database.
+
+    Raise UnsupportedHTML if the note has elements, such as tables and
+    images, that should be converted by pandoc.
+    """
+    builder = _TreeBuilder()
+    builder.feed(html)
+    builder.close()
+    blocks = _blocks(builder.root.children)
+    if not blocks:
+        return ""
+    return "\n\n".join(blocks) + "\n"
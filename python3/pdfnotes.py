@@ -3,41 +3,89 @@
 """
 Adapted from code written by Hamed MP, published at
 https://gist.github.com/HamedMP/03440cca542ee7ae279175b78499fabf
+
+Usage: pdfnotes.py file.pdf [citekey [pages]]
+       pdfnotes.py --batch [--jobs N] [--pages N] [manifest]
+
+In batch mode, each line of the manifest (or of the standard input) has the
+path of a PDF, optionally followed by a citation key and the pages of the
+document in the publication, separated by tabs. The PDFs are read by a pool
+of processes, the ones with more than N pages (50 by default) are split
+into ranges of N pages, and the notes of each document are written as soon
+as all of its pages were read, under a "#" header with its citation key.
+
+The annotations extracted from each PDF are saved in the "pdfnotes"
+directory inside zotcite's temporary directory and reused while the PDF
+does not change. If $Zotcite_pdfnotes_hash is "1", a PDF whose modification
+time changed is only parsed again if its contents changed too.
 """
 
 import sys
 import os
 import re
+import pickle
+import hashlib
+import argparse
+import concurrent.futures
 
-try:
-    import PyQt5
-except ImportError:
-    sys.stdout.write("Please, install the Python3 module PyQt5")
-    sys.exit(1)
+from zotero import zotcite_tmpdir
 
-try:
-    import popplerqt5
-except ImportError:
-    sys.stdout.write("Please, install the Python3 module popplerqt5")
-    sys.exit(1)
+# Increase whenever the structure of the cached annotations changes
+_cache_version = 1
 
 
-def main():
-    doc = popplerqt5.Poppler.Document.load(sys.argv[1])
-    if doc is None:
+def _import_poppler():
+    try:
+        import PyQt5.QtCore
+    except ImportError:
+        sys.stdout.write("Please, install the Python3 module PyQt5")
+        sys.exit(1)
+
+    try:
+        import popplerqt5
+    except ImportError:
+        sys.stdout.write("Please, install the Python3 module popplerqt5")
+        sys.exit(1)
+
+    return PyQt5.QtCore, popplerqt5
+
+
+def extract(path, pg):
+    """Return the annotations of a PDF as a list of
+    [page count, column, y, kind, text, author, page label]
+
+    path (string): The PDF file.
+    pg   (string): Either the range of pages of the document in the
+                   publication (e.g. "125-143") or the number of its first
+                   page. Empty if unknown.
+
+    Exit with status 33 if the file cannot be opened as a PDF.
+    """
+
+    res = _extract_pages(path, pg, 0, None)
+    if res is None:
         sys.exit(33)
+    return res[0]
 
-    if len(sys.argv) > 2:
-        citekey = sys.argv[2]
-    else:
-        citekey = ""
+
+def _extract_pages(path, pg, first, last, textlist=True):
+    """Return the annotations of the pages from first to last - 1 (or to the
+    end of the document if last is None) and the number of pages of the PDF,
+    or None if the file cannot be opened as a PDF.
+
+    If textlist is False, poppler lays out the text of the page again for
+    each line of each highlight, which is much slower."""
+
+    QtCore, popplerqt5 = _import_poppler()
+    doc = popplerqt5.Poppler.Document.load(path)
+    if doc is None:
+        return None
 
     # Sometimes, the page labels are spurious. So the priority is:
     # 1. given page range; 2. page label; 3. given starting page.
     page1 = 1
     has_pg_range = False
-    if len(sys.argv) > 3:
-        pg = sys.argv[3]
+    if pg:
         if pg.find("-"):
             has_pg_range = True
             pIni = int(re.sub("-.*", "", pg))
@@ -48,83 +96,387 @@ def main():
             if doc.numPages() <= nPgs and (nPgs - doc.numPages()) < 2:
                 page1 = pEnd - doc.numPages() + 1
         else:
-            page1 = int(sys.argv[3])
-
-    if os.getenv("ZYearPageSep") is None:
-        ypsep = ", p. "
-    else:
-        ypsep = os.getenv("ZYearPageSep")
+            page1 = int(pg)
 
     notes = []
+    if last is None or last > doc.numPages():
+        last = doc.numPages()
 
-    # Count the pages because not all page labels can be easily converted into
-    # numbers (examples: A1 and III)
-    pnum = 0
-
-    for i in range(doc.numPages()):
+    for i in range(first, last):
         page = doc.page(i)
-        pnum += 1
+        annotations = page.annotations()
+        if not annotations:
+            continue
+
+        # Count the pages because not all page labels can be easily converted
+        # into numbers (examples: A1 and III)
+        pnum = i + 1
         pgnum = str(i + page1)
         if not has_pg_range and page.label():
             pgnum = page.label()
 
-        annotations = page.annotations()
         (pwidth, pheight) = (page.pageSize().width(), page.pageSize().height())
-        if annotations:
-            for a in annotations:
-                if isinstance(a, popplerqt5.Poppler.Annotation):
-                    # Guess the annotation's column for pages with two columns
-                    if a.boundary().topRight().x() < 0.6:
-                        c = 1
-                    else:
-                        c = 2
-
-                    # Get the y coordinate to to print the annotations in the
-                    # correct order
-                    y = a.boundary().topRight().y()
-
-                    if a.contents():
-                        txt = a.contents() + " [annotation"
-                        if a.author():
-                            txt = txt + " by " + a.author()
-                        if citekey:
-                            txt = txt + " on " + citekey
-                        txt = txt + ypsep + pgnum + "]\n"
-
-                        # Decrease the value of y to ensure that the comment
-                        # on a highlighted text will be printed before the
-                        # highlighted text itself
-                        notes.append([pnum, c, y - 0.0000001, txt])
-
-                    if isinstance(a, popplerqt5.Poppler.HighlightAnnotation):
-                        quads = a.highlightQuads()
-                        txt = ""
-                        for quad in quads:
-                            rect = (
-                                quad.points[0].x() * pwidth,
-                                quad.points[0].y() * pheight,
-                                quad.points[2].x() * pwidth,
-                                quad.points[2].y() * pheight,
-                            )
-                            bdy = PyQt5.QtCore.QRectF()
+        # The words of the page, read only if it has highlights
+        words = None
+        for a in annotations:
+            if isinstance(a, popplerqt5.Poppler.Annotation):
+                # Guess the annotation's column for pages with two columns
+                if a.boundary().topRight().x() < 0.6:
+                    c = 1
+                else:
+                    c = 2
+
+                # Get the y coordinate to to print the annotations in the
+                # correct order
+                y = a.boundary().topRight().y()
+
+                if a.contents():
+                    # Decrease the value of y to ensure that the comment
+                    # on a highlighted text will be printed before the
+                    # highlighted text itself
+                    notes.append(
+                        [
+                            pnum,
+                            c,
+                            y - 0.0000001,
+                            "comment",
+                            a.contents(),
+                            a.author(),
+                            pgnum,
+                        ]
+                    )
+
+                if isinstance(a, popplerqt5.Poppler.HighlightAnnotation):
+                    quads = a.highlightQuads()
+                    txt = ""
+                    for quad in quads:
+                        rect = (
+                            quad.points[0].x() * pwidth,
+                            quad.points[0].y() * pheight,
+                            quad.points[2].x() * pwidth,
+                            quad.points[2].y() * pheight,
+                        )
+                        if textlist:
+                            if words is None:
+                                words = _words(page)
+                            txt = txt + _text_in_rect(words, rect) + "\n"
+                        else:
+                            bdy = QtCore.QRectF()
                             bdy.setCoords(*rect)
                             txt = txt + str(page.text(bdy)) + "\n"
 
-                        txt = txt.replace("-\n", "")
-                        txt = txt.replace("\n", " ")
-                        txt = re.sub("^ *", "", txt)
-                        txt = re.sub(" *$", "", txt)
-                        if txt:
-                            txt = "> " + txt + " ["
-                            if citekey:
-                                txt = txt + citekey
-                            txt = txt + ypsep + pgnum + "]\n"
-                            notes.append([pnum, c, y, txt])
+                    txt = txt.replace("-\n", "")
+                    txt = txt.replace("\n", " ")
+                    txt = re.sub("^ *", "", txt)
+                    txt = re.sub(" *$", "", txt)
+                    if txt:
+                        notes.append([pnum, c, y, "highlight", txt, "", pgnum])
+    return notes, doc.numPages()
+
+
+def _words(page):
+    """Return the words of the page as a list of
+    [left, top, right, bottom, text, space after, TextBox]"""
+    words = []
+    for box in page.textList():
+        r = box.boundingBox()
+        words.append(
+            [
+                r.left(),
+                r.top(),
+                r.right(),
+                r.bottom(),
+                box.text(),
+                box.hasSpaceAfter(),
+                box,
+            ]
+        )
+    return words
+
+
+def _text_in_rect(words, rect):
+    """Return the text of the characters whose center is in the rectangle, as
+    poppler's Page.text() does, but from the words read by _words()"""
+    x1, x2 = sorted((rect[0], rect[2]))
+    y1, y2 = sorted((rect[1], rect[3]))
+    txt = ""
+    for left, top, right, bottom, text, space, box in words:
+        if not y1 <= (top + bottom) / 2 <= y2 or right < x1 or left > x2:
+            continue
+        if left < x1 or right > x2:
+            # Only part of the word is in the rectangle
+            chars = []
+            for j in range(len(text)):
+                cr = box.charBoundingBox(j)
+                if x1 <= (cr.left() + cr.right()) / 2 <= x2:
+                    chars.append(text[j])
+            text = "".join(chars)
+        if text:
+            txt = txt + text + (" " if space else "")
+    # Do not separate hyphens at the end of the line from the line break
+    return txt.rstrip(" ")
+
+
+def _file_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _cache_key(path, pg):
+    st = os.stat(path)
+    return (_cache_version, path, pg, st.st_size, st.st_mtime_ns)
+
+
+def _cache_file(path):
+    return os.path.join(
+        zotcite_tmpdir(),
+        "pdfnotes",
+        hashlib.sha1(path.encode("utf-8")).hexdigest() + ".pickle",
+    )
+
+
+def _read_cache(path, key):
+    """Return the annotations saved for the PDF or None if it changed"""
+    cache = _cache_file(path)
+    try:
+        with open(cache, "rb") as f:
+            saved = pickle.load(f)
+        if saved["key"] == key:
+            return saved["notes"]
+        if (
+            os.getenv("Zotcite_pdfnotes_hash") == "1"
+            and saved["key"][:4] == key[:4]
+            and saved["hash"] == _file_hash(path)
+        ):
+            # Only the modification time changed
+            saved["key"] = key
+            _save(cache, saved)
+            return saved["notes"]
+    except Exception:
+        pass
+    return None
+
+
+def _write_cache(path, key, notes):
+    saved = {
+        "key": key,
+        "hash": _file_hash(path) if os.getenv("Zotcite_pdfnotes_hash") == "1" else "",
+        "notes": notes,
+    }
+    cache = _cache_file(path)
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        _save(cache, saved)
+    except OSError:
+        pass
+
+
+def _save(cache, saved):
+    # Write to a temporary file first because another process might be
+    # reading the cache
+    with open(cache + str(os.getpid()), "wb") as f:
+        pickle.dump(saved, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(cache + str(os.getpid()), cache)
+
+
+def cached_extract(path, pg):
+    """Return extract(path, pg), reusing the annotations saved by a previous
+    call if the PDF did not change"""
+
+    path = os.path.abspath(path)
+    try:
+        key = _cache_key(path, pg)
+    except OSError:
+        sys.exit(33)
+    notes = _read_cache(path, key)
+    if notes is None:
+        notes = extract(path, pg)
+        _write_cache(path, key, notes)
+    return notes
+
+
+def format_notes(notes, citekey, ypsep):
+    """Return the annotations sorted by page, column and position as
+    markdown paragraphs"""
+
+    lines = []
+    for pnum, c, y, kind, text, author, pgnum in sorted(
+        notes, key=lambda x: (x[0], x[1], x[2])
+    ):
+        if kind == "comment":
+            txt = text + " [annotation"
+            if author:
+                txt = txt + " by " + author
+            if citekey:
+                txt = txt + " on " + citekey
+            txt = txt + ypsep + pgnum + "]\n"
+        else:
+            txt = "> " + text + " ["
+            if citekey:
+                txt = txt + citekey
+            txt = txt + ypsep + pgnum + "]\n"
+        lines.append(txt)
+    return lines
+
+
+def _ypsep():
+    if os.getenv("ZYearPageSep") is None:
+        return ", p. "
+    return os.getenv("ZYearPageSep")
+
+
+def _read_manifest(f):
+    """Return a list of [path, citekey, pages] from the lines of f"""
+    docs = []
+    for line in f:
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            continue
+        fields = line.split("\t") + ["", ""]
+        docs.append([os.path.abspath(os.path.expanduser(fields[0])), *fields[1:3]])
+    return docs
+
+
+def _write_notes(doc, notes, ypsep):
+    sys.stdout.write("# " + (doc[1] or doc[0]) + "\n\n")
+    for txt in format_notes(notes, doc[1], ypsep):
+        print(txt)
+    sys.stdout.flush()
+
+
+def _positive(value):
+    """Convert an argument into an integer greater than 0"""
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return n
+
+
+def batch(argv):
+    """Extract the annotations of the PDFs listed in a manifest in parallel.
+    Return 0 if all of them could be read and 33 otherwise."""
+
+    parser = argparse.ArgumentParser(
+        prog="pdfnotes.py --batch",
+        description="Extract the annotations of many PDFs",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="number of processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--pages",
+        type=_positive,
+        default=50,
+        help="split documents into ranges of PAGES pages (default: %(default)s)",
+    )
+    parser.add_argument("manifest", nargs="?", help="default: standard input")
+    args = parser.parse_args(argv)
+
+    if args.manifest:
+        with open(args.manifest, encoding="utf-8") as f:
+            docs = _read_manifest(f)
+    else:
+        docs = _read_manifest(sys.stdin)
+
+    ypsep = _ypsep()
+    status = 0
+
+    # First, write the notes that are in the cache
+    todo = []
+    for doc in docs:
+        try:
+            doc.append(_cache_key(doc[0], doc[2]))
+        except OSError:
+            sys.stderr.write("Could not read " + doc[0] + "\n")
+            status = 33
+            continue
+        notes = _read_cache(doc[0], doc[3])
+        if notes is None:
+            todo.append(doc)
+        elif notes:
+            _write_notes(doc, notes, ypsep)
+    if not todo:
+        return status
+
+    # Fail before starting the processes if popplerqt5 is missing
+    _import_poppler()
+
+    with concurrent.futures.ProcessPoolExecutor(max(1, args.jobs)) as pool:
+        # The first range of each document also returns its number of pages,
+        # and only then its other ranges are submitted.
+        tasks = {}
+        pending = {}
+        results = {}
+        failed = set()
+        for i, doc in enumerate(todo):
+            t = pool.submit(_extract_pages, doc[0], doc[2], 0, args.pages)
+            tasks[t] = (i, True)
+            pending[i] = 1
+            results[i] = []
+        while tasks:
+            done, _ = concurrent.futures.wait(
+                tasks, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for t in done:
+                i, first = tasks.pop(t)
+                doc = todo[i]
+                try:
+                    res = t.result()
+                    error = ""
+                except Exception as e:
+                    # For example, a malformed page range in the manifest
+                    res = None
+                    error = ": " + type(e).__name__ + ": " + str(e)
+                pending[i] -= 1
+                if res is None:
+                    # Neither written nor cached, even if other ranges of the
+                    # document were read
+                    if i not in failed:
+                        sys.stderr.write("Could not read " + doc[0] + error + "\n")
+                        failed.add(i)
+                        status = 33
+                elif i not in failed:
+                    results[i] += res[0]
+                    if first:
+                        for p in range(args.pages, res[1], args.pages):
+                            t = pool.submit(
+                                _extract_pages, doc[0], doc[2], p, p + args.pages
+                            )
+                            tasks[t] = (i, False)
+                            pending[i] += 1
+                if pending[i] == 0:
+                    if i not in failed:
+                        _write_cache(doc[0], doc[3], results[i])
+                        if results[i]:
+                            _write_notes(doc, results[i], ypsep)
+                    del results[i]
+    return status
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        sys.exit(batch(sys.argv[2:]))
+
+    if len(sys.argv) > 2:
+        citekey = sys.argv[2]
+    else:
+        citekey = ""
+
+    if len(sys.argv) > 3:
+        pg = sys.argv[3]
+    else:
+        pg = ""
 
+    notes = cached_extract(sys.argv[1], pg)
     if notes:
-        snotes = sorted(notes, key=lambda x: (x[0], x[1], x[2]))
-        for n in snotes:
-            print(n[3])
+        for txt in format_notes(notes, citekey, _ypsep()):
+            print(txt)
     else:
         sys.exit(34)
 
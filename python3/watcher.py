@@ -0,0 +1,137 @@
+""" Watch files for changes in a background thread """
+import os
+import sys
+import select
+import struct
+import threading
+
+# Zotero writes to its database many times in a row while it syncs. The
+# watchers below only count a change after the files have been quiet for
+# `debounce` seconds, so that a sync triggers a single reload.
+
+
+class PollingWatcher:
+    """Check the mtime and size of the files every `interval` seconds"""
+
+    def __init__(self, paths, debounce=1.0, interval=2.0):
+        self.paths = list(paths)
+        # Number of (debounced) changes seen so far
+        self.changes = 0
+        self._debounce = debounce
+        self._interval = interval
+        self._stop = threading.Event()
+        # Taken now, so that changes made before the thread runs are seen
+        self._last = self._signature()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _signature(self):
+        sig = []
+        for p in self.paths:
+            try:
+                st = os.stat(p)
+                sig.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                sig.append(None)
+        return sig
+
+    def _run(self):
+        last = self._last
+        while not self._stop.wait(self._interval):
+            sig = self._signature()
+            if sig == last:
+                continue
+            # Wait until the files stop changing
+            while not self._stop.wait(self._debounce):
+                last = sig
+                sig = self._signature()
+                if sig == last:
+                    break
+            last = sig
+            self.changes += 1
+
+    def close(self):
+        self._stop.set()
+
+
+class InotifyWatcher:
+    """Use Linux's inotify to watch the directories where the files are"""
+
+    _IN_MODIFY = 0x00000002
+    _IN_CLOSE_WRITE = 0x00000008
+    _IN_MOVED_TO = 0x00000080
+    _IN_CREATE = 0x00000100
+    _IN_DELETE = 0x00000200
+    _IN_CLOEXEC = 0o2000000
+
+    def __init__(self, paths, debounce=1.0):
+        import ctypes
+        import ctypes.util
+
+        self.paths = list(paths)
+        self.changes = 0
+        self._debounce = debounce
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = libc.inotify_init1(self._IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        mask = (
+            self._IN_MODIFY
+            | self._IN_CLOSE_WRITE
+            | self._IN_MOVED_TO
+            | self._IN_CREATE
+            | self._IN_DELETE
+        )
+        # Names of the watched files in each watched directory
+        self._names = {}
+        for p in self.paths:
+            d, name = os.path.split(os.path.abspath(p))
+            wd = libc.inotify_add_watch(self._fd, os.fsencode(d), mask)
+            if wd < 0:
+                os.close(self._fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed: " + d)
+            self._names.setdefault(wd, set()).add(os.fsencode(name))
+
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _relevant(self, data):
+        """Return True if any event in data is about one of the files"""
+        found = False
+        i = 0
+        while i + 16 <= len(data):
+            wd, _, _, length = struct.unpack_from("iIII", data, i)
+            name = data[i + 16 : i + 16 + length].rstrip(b"\0")
+            if name in self._names.get(wd, ()):
+                found = True
+            i += 16 + length
+        return found
+
+    def _run(self):
+        try:
+            while not self._closed:
+                if not self._relevant(os.read(self._fd, 65536)):
+                    continue
+                # Wait until the files stop changing
+                while select.select([self._fd], [], [], self._debounce)[0]:
+                    os.read(self._fd, 65536)
+                self.changes += 1
+        except OSError:
+            # The file descriptor was closed
+            pass
+
+    def close(self):
+        self._closed = True
+        os.close(self._fd)
+
+
+def watch(paths, debounce=1.0):
+    """Return an InotifyWatcher on Linux and a PollingWatcher otherwise"""
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(paths, debounce)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(paths, debounce)
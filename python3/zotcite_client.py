@@ -0,0 +1,117 @@
+""" Class ZoteroClient """
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import subprocess
+
+from zotcite_server import METHODS, default_socket
+
+
+class ZoteroServerError(Exception):
+    """Error raised by ZoteroEntries in zotcite_server.py"""
+
+
+class ZoteroClient:
+    """Replacement for ZoteroEntries that forwards the calls of its public
+    methods to zotcite_server.py, which is started if it is not running"""
+
+    # Seconds that a server started by the client waits for new clients
+    # after the last one disconnects
+    _idle_timeout = 600
+
+    def __init__(self, path=None, start=True):
+        self._path = path or default_socket()
+        self._sock = None
+        self._file = None
+        self._id = 0
+        # Start the server if it is not running?
+        self._start = start
+        self._connect()
+
+    def _connect(self):
+        if self._try_connect():
+            return
+        if not self._start:
+            raise ZoteroServerError("zotcite_server.py is not running")
+        self._start_server()
+        # Loading the data might take a while on the first run
+        for _ in range(600):
+            time.sleep(0.1)
+            if self._try_connect():
+                return
+            if self._server.poll() is not None:
+                break
+        raise ZoteroServerError(
+            "Could not connect to zotcite_server.py. See "
+            + os.path.join(os.path.dirname(self._path), "zotcite_server.log")
+        )
+
+    def _try_connect(self):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(self._path)
+        except OSError:
+            s.close()
+            return False
+        self._sock = s
+        self._file = s.makefile("rb")
+        return True
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _start_server(self):
+        # Within Vim, sys.executable might be Vim itself
+        python = shutil.which("python3") or sys.executable
+        server = os.path.join(os.path.dirname(__file__), "zotcite_server.py")
+        with open(
+            os.path.join(os.path.dirname(self._path), "zotcite_server.log"), "ab"
+        ) as log:
+            self._server = subprocess.Popen(
+                [
+                    python,
+                    server,
+                    "--socket",
+                    self._path,
+                    "--idle-timeout",
+                    str(self._idle_timeout),
+                ],
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=log,
+                start_new_session=True,
+            )
+
+    def _call(self, method, *params):
+        self._id += 1
+        request = {"jsonrpc": "2.0", "id": self._id, "method": method}
+        request["params"] = params
+        data = json.dumps(request).encode("utf-8") + b"\n"
+        try:
+            self._sock.sendall(data)
+            line = self._file.readline()
+            if not line:
+                raise ConnectionError
+        except OSError:
+            # The server was restarted: try once more
+            self._close()
+            self._connect()
+            self._sock.sendall(data)
+            line = self._file.readline()
+        response = json.loads(line)
+        if "error" in response:
+            raise ZoteroServerError(response["error"]["message"])
+        return response["result"]
+
+    def __getattr__(self, name):
+        if name not in METHODS:
+            raise AttributeError(name)
+        return lambda *params: self._call(name, *params)
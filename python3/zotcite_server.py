@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+"""
+Serve the references of a single ZoteroEntries object to many Vim instances.
+
+The server listens on a Unix socket (by default, zotcite.sock in zotcite's
+temporary directory) and speaks JSON-RPC 2.0, one JSON object per line. The
+methods are the public methods of ZoteroEntries, for example:
+
+    {"jsonrpc": "2.0", "id": 1, "method": "GetMatch", "params": ["marx", "doc.md"]}
+
+Usage: zotcite_server.py [--socket PATH] [--idle-timeout SECONDS]
+
+Vim uses zotcite_client.ZoteroClient to talk to the server, which it starts
+if it is not running yet.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import socketserver
+
+from zotero import ZoteroEntries, zotcite_tmpdir
+
+METHODS = (
+    "GetMatch",
+    "GetRefData",
+    "GetAttachment",
+    "GetAnnotations",
+    "GetNotes",
+    "GetCitationById",
+    "GetCSL",
+    "CheckCitations",
+    "CheckBuffer",
+    "FullTextSearch",
+    "SetCollections",
+    "Info",
+)
+
+
+def default_socket():
+    return os.path.join(zotcite_tmpdir(), "zotcite.sock")
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.connected(1)
+        try:
+            for line in self.rfile:
+                response = self.server.dispatch(line)
+                self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+                self.wfile.flush()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.server.connected(-1)
+
+
+class ZoteroServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, zotero):
+        self._zotero = zotero
+        # ZoteroEntries is not thread safe: run one call at a time
+        self._lock = threading.Lock()
+        self._clients = 0
+        self._last_seen = time.monotonic()
+        super().__init__(path, _Handler)
+
+    def connected(self, n):
+        with self._lock:
+            self._clients += n
+            self._last_seen = time.monotonic()
+
+    def idle_time(self):
+        with self._lock:
+            if self._clients:
+                return 0
+            return time.monotonic() - self._last_seen
+
+    def dispatch(self, line):
+        try:
+            request = json.loads(line)
+            rid = request.get("id")
+            method = request["method"]
+            params = request.get("params", [])
+        except (ValueError, KeyError, AttributeError):
+            return {
+                "jsonrpc": "2.0",
+                "id": None,
+                "error": {"code": -32700, "message": "Parse error"},
+            }
+        if method not in METHODS:
+            return {
+                "jsonrpc": "2.0",
+                "id": rid,
+                "error": {"code": -32601, "message": "Method not found"},
+            }
+        try:
+            with self._lock:
+                result = getattr(self._zotero, method)(*params)
+        except Exception as e:
+            message = type(e).__name__ + ": " + str(e)
+            return {
+                "jsonrpc": "2.0",
+                "id": rid,
+                "error": {"code": -32000, "message": message},
+            }
+        return {"jsonrpc": "2.0", "id": rid, "result": result}
+
+
+def _is_running(path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve Zotero references")
+    parser.add_argument("--socket", default=default_socket())
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=0,
+        help="exit after SECONDS without clients (0: never)",
+    )
+    args = parser.parse_args()
+
+    if os.path.exists(args.socket):
+        if _is_running(args.socket):
+            sys.stderr.write("zotcite_server is already running\n")
+            sys.exit(1)
+        # Left behind by a server that did not exit cleanly
+        os.remove(args.socket)
+
+    zotero = ZoteroEntries()
+    if not hasattr(zotero, "_e"):
+        # The error message was already written by ZoteroEntries
+        sys.exit(2)
+
+    server = ZoteroServer(args.socket, zotero)
+    try:
+        if args.idle_timeout > 0:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            while server.idle_time() < args.idle_timeout:
+                time.sleep(min(args.idle_timeout, 5))
+            server.shutdown()
+        else:
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
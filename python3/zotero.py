@@ -2,15 +2,457 @@
 import sys
 import os
 import re
+import copy
+import time
+import heapq
+import html
+import pickle
+import shutil
 import sqlite3
+import inspect
+import tempfile
+import functools
 import subprocess
+import threading
+from pathlib import Path
+from bisect import bisect_left, bisect_right
+from collections import deque, OrderedDict
+from html2markdown import html2markdown, UnsupportedHTML
+from watcher import watch, PollingWatcher
 
 # A lot of code was either adapted or plainly copied from citation_vim,
 # written by Rafael Schouten: https://github.com/rafaqz/citation.vim
 # Code and/or ideas were also adapted from zotxt, pypandoc, and pandocfilters.
 
 # To debug this code, create a /tmp/test.md file and do:
-# pandoc testzotcite.md -t json | /full/path/to/zotcite/python3/zotref
+# pandoc testzotcite.md -t json | /full/path/to/zotcite/python3/zotref.py
+
+
+def zotcite_tmpdir():
+    """Return the path of the directory where zotcite stores its files"""
+    if os.getenv("Zotcite_tmpdir") is None:
+        if os.getenv("XDG_CACHE_HOME") and os.path.isdir(
+            str(os.getenv("XDG_CACHE_HOME"))
+        ):
+            return str(os.getenv("XDG_CACHE_HOME")) + "/zotcite"
+        if os.getenv("APPDATA") and os.path.isdir(str(os.getenv("APPDATA"))):
+            return str(os.getenv("APPDATA")) + "/zotcite"
+        if os.path.isdir(os.path.expanduser("~/.cache")):
+            return os.path.expanduser("~/.cache/zotcite")
+        if os.path.isdir(os.path.expanduser("~/Library/Caches")):
+            return os.path.expanduser("~/Library/Caches/zotcite")
+        return "/tmp/.zotcite"
+    return os.path.expanduser(str(os.getenv("Zotcite_tmpdir")))
+
+
+class Timings:
+    """Number of calls and duration of the methods of ZoteroEntries"""
+
+    # Number of durations kept for each method to compute percentiles
+    _samples = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Method name: [calls, total seconds, recent durations]
+        self._methods = {}
+
+    def add(self, name, seconds):
+        with self._lock:
+            if name not in self._methods:
+                self._methods[name] = [0, 0.0, deque(maxlen=self._samples)]
+            m = self._methods[name]
+            m[0] += 1
+            m[1] += seconds
+            m[2].append(seconds)
+
+    def report(self):
+        """Return one line for each method, the slowest first"""
+        with self._lock:
+            methods = [
+                (m[1], name, m[0], sorted(m[2])) for name, m in self._methods.items()
+            ]
+        lines = []
+        for total, name, calls, durations in sorted(methods, reverse=True):
+            n = len(durations)
+            lines.append(
+                f"{name}: {calls} calls, total {total:.3f} s,"
+                f" p50 {durations[n // 2] * 1000:.2f} ms,"
+                f" p95 {durations[min(n - 1, int(n * 0.95))] * 1000:.2f} ms"
+            )
+        return lines
+
+
+def _timed(method):
+    """Record the duration of the method's calls if $Zotcite_timing is 1"""
+
+    name = method.__name__
+    if inspect.isgeneratorfunction(method):
+        # Only count the time spent producing the items
+        @functools.wraps(method)
+        def generator(self, *args, **kwargs):
+            if self._timings is None:
+                yield from method(self, *args, **kwargs)
+                return
+            elapsed = 0.0
+            items = method(self, *args, **kwargs)
+            while True:
+                t = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - t
+                yield item
+            self._timings.add(name, elapsed)
+
+        return generator
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._timings is None:
+            return method(self, *args, **kwargs)
+        t = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._timings.add(name, time.perf_counter() - t)
+
+    return wrapper
+
+
+class Entry:
+    """The fields of a reference used by GetMatch and by the other frequent
+    lookups. GetRefData reads the remaining fields from the database."""
+
+    __slots__ = ("zotkey", "citekey", "etype", "alastnm", "year", "title")
+
+    def __init__(self, zotkey, citekey, etype):
+        self.zotkey = zotkey
+        self.citekey = citekey
+        # Item types are shared by many references
+        self.etype = sys.intern(etype)
+        self.alastnm = ""
+        self.year = ""
+        self.title = ""
+
+
+def _fuzzy_score(s, ptrn):
+    """Score how well ptrn matches s, which must contain ptrn's characters in
+    the same order. Prefixes are better than substrings, which are better
+    than scattered characters. Matches at the beginning of words are better
+    than matches inside words."""
+
+    i = s.find(ptrn)
+    if i == 0:
+        return 100
+    if i > 0:
+        while i != -1:
+            if not s[i - 1].isalnum():
+                return 80
+            i = s.find(ptrn, i + 1)
+        return 60
+    score = 40
+    pos = -1
+    for c in ptrn:
+        j = s.find(c, pos + 1)
+        if j == 0 or not s[j - 1].isalnum():
+            score += 2
+        elif pos != -1 and j > pos + 1:
+            score -= 1
+        pos = j
+    return max(1, min(score, 56))
+
+
+class SearchIndex:
+    """Index of citation keys, authors and titles used by GetMatch
+
+    Prefixes are found by bisection of sorted lists of lowercased strings.
+    Substrings are found by searching a single string where all lowercased
+    values are joined, so that the work is done by C code instead of a Python
+    loop. The strings containing each trigram are remembered the first time
+    the trigram is sought, and patterns with three or more characters are
+    then only compared with these strings.
+
+    The fuzzy search finds the strings where the pattern's characters occur
+    in the same order with a regular expression on the joined strings, and
+    only these strings are scored.
+
+    While a citation key is typed, each pattern extends the previous one and
+    its matches are a subset of the previous matches. Hence, the matches of
+    the last few patterns are remembered and, if there are not many of them,
+    only they are compared with a longer pattern.
+    """
+
+    _sep = "\0"
+
+    # Number of patterns whose matches are remembered, and maximum number of
+    # matches remembered for each pattern. Above this number, searching the
+    # joined strings is faster than comparing the matches one by one.
+    _recent_size = 8
+    _recent_max = 20000
+
+    def __init__(self, entries):
+        """entries (dict): ZoteroEntries' references, indexed by item ID"""
+
+        self._keys = list(entries.keys())
+        citekeys = [entries[k].citekey.lower() for k in self._keys]
+        titles = [entries[k].title.lower() for k in self._keys]
+
+        self._citekeys = self._sorted(citekeys)
+        self._titles = self._sorted(titles)
+        self._citekeys_text = self._joined(citekeys)
+        self._titles_text = self._joined(titles)
+        self._authors_text = self._joined(
+            [sys.intern(entries[k].alastnm.lower()) for k in self._keys]
+        )
+
+        # Only the first letter of the authors' last names is sought
+        self._initials = {}
+        for i, k in enumerate(self._keys):
+            if entries[k].alastnm:
+                initial = entries[k].alastnm[0].lower()
+                self._initials.setdefault(initial, []).append(i)
+
+        # (kind of search, pattern): positions of the matches
+        self._recent = OrderedDict()
+
+    @staticmethod
+    def _sorted(strings):
+        pairs = sorted(zip(strings, range(len(strings))))
+        return ([s for s, _ in pairs], [i for _, i in pairs])
+
+    @classmethod
+    def _joined(cls, strings):
+        starts = []
+        pos = 1
+        for s in strings:
+            starts.append(pos)
+            pos += len(s) + 1
+        return (cls._sep + cls._sep.join(strings), starts, strings, {})
+
+    @staticmethod
+    def _prefix(index, ptrn):
+        strings, positions = index
+        lo = bisect_left(strings, ptrn)
+        hi = bisect_left(strings, ptrn + "\U0010ffff", lo)
+        return positions[lo:hi]
+
+    def _scan(self, index, ptrn):
+        text, starts = index[0], index[1]
+        found = []
+        n = len(starts)
+        pos = text.find(ptrn)
+        while pos != -1:
+            i = bisect_right(starts, pos) - 1
+            found.append(i)
+            # Continue the search in the next string
+            if i + 1 == n:
+                break
+            pos = text.find(ptrn, starts[i + 1])
+        return found
+
+    def _substring(self, index, ptrn):
+        if self._sep in ptrn:
+            return []
+        if len(ptrn) < 3:
+            return self._scan(index, ptrn)
+
+        strings, trigrams = index[2], index[3]
+        candidates = None
+        for j in range(len(ptrn) - 2):
+            t = trigrams.get(ptrn[j : j + 3])
+            if t is not None and (candidates is None or len(t) < len(candidates)):
+                candidates = t
+        if candidates is None:
+            candidates = self._scan(index, ptrn[:3])
+            trigrams[ptrn[:3]] = candidates
+        return [i for i in candidates if ptrn in strings[i]]
+
+    def _scan_regex(self, index, regex):
+        text, starts = index[0], index[1]
+        found = []
+        n = len(starts)
+        mo = regex.search(text)
+        while mo is not None:
+            i = bisect_right(starts, mo.start()) - 1
+            found.append(i)
+            if i + 1 == n:
+                break
+            mo = regex.search(text, starts[i + 1])
+        return found
+
+    def _narrowed(self, kind, ptrn):
+        """Return the longest remembered pattern of this kind that ptrn begins
+        with and its matches, or None"""
+        found = None
+        for key in self._recent:
+            if key[0] == kind and ptrn.startswith(key[1]):
+                if found is None or len(key[1]) > len(found[1]):
+                    found = key
+        if found is None:
+            return None
+        self._recent.move_to_end(found)
+        return found[1], self._recent[found]
+
+    def _remember(self, kind, ptrn, positions):
+        if len(positions) > self._recent_max:
+            return
+        self._recent[(kind, ptrn)] = positions
+        self._recent.move_to_end((kind, ptrn))
+        if len(self._recent) > self._recent_size:
+            self._recent.popitem(last=False)
+
+    def fuzzy(self, ptrn, k):
+        """Return the item IDs of the k references that best match ptrn
+
+        ptrn   (string): Characters that must occur in this order in the
+                         citation key, the authors' last names or the title.
+        k         (int): Maximum number of item IDs returned.
+        """
+
+        ptrn = ptrn.lower()
+        if ptrn == "":
+            return self._keys[:k]
+        if self._sep in ptrn:
+            return []
+
+        # If the search for a shorter pattern found fewer than k references,
+        # it found all references that might match ptrn
+        narrowed = self._narrowed(("fuzzy", k), ptrn)
+        if narrowed is not None:
+            if narrowed[0] == ptrn:
+                return [self._keys[i] for i in narrowed[1][:k]]
+            scores = {}
+            for bonus, index in (
+                (3, self._citekeys_text),
+                (2, self._authors_text),
+                (0, self._titles_text),
+            ):
+                strings = index[2]
+                for i in narrowed[1]:
+                    if self._subsequence(strings[i], ptrn):
+                        score = _fuzzy_score(strings[i], ptrn) + bonus
+                        if score > scores.get(i, 0):
+                            scores[i] = score
+            return self._best(scores, k, ptrn)
+
+        # Citation keys beginning with ptrn have the highest score
+        prefixes = sorted(self._prefix(self._citekeys, ptrn))
+        if len(prefixes) >= k:
+            return [self._keys[i] for i in prefixes[:k]]
+
+        # Matches in citation keys are slightly better than in the authors'
+        # names, which are slightly better than in titles. Fields where a
+        # character of ptrn never occurs are skipped.
+        fields = [
+            (bonus, index)
+            for bonus, index in (
+                (3, self._citekeys_text),
+                (2, self._authors_text),
+                (0, self._titles_text),
+            )
+            if all(c in index[0] for c in set(ptrn))
+        ]
+
+        # Substrings score at least 60, scattered characters less than 60.
+        # Hence, these are only sought if there are fewer than k substrings.
+        scores = {}
+        for bonus, index in fields:
+            strings = index[2]
+            for i in self._substring(index, ptrn):
+                score = _fuzzy_score(strings[i], ptrn) + bonus
+                if score > scores.get(i, 0):
+                    scores[i] = score
+
+        if len(scores) < k:
+            # The first occurrence of each character after the previous one
+            regex = re.escape(ptrn[0])
+            for c in ptrn[1:]:
+                regex += "[^" + self._sep + re.escape(c) + "]*" + re.escape(c)
+            regex = re.compile(regex)
+            substrings = set(scores)
+            for bonus, index in fields:
+                strings = index[2]
+                for i in self._scan_regex(index, regex):
+                    if i in substrings:
+                        continue
+                    score = _fuzzy_score(strings[i], ptrn) + bonus
+                    if score > scores.get(i, 0):
+                        scores[i] = score
+
+        return self._best(scores, k, ptrn)
+
+    @staticmethod
+    def _subsequence(s, ptrn):
+        """Return True if the characters of ptrn occur in s in this order"""
+        pos = -1
+        for c in ptrn:
+            pos = s.find(c, pos + 1)
+            if pos == -1:
+                return False
+        return True
+
+    def _best(self, scores, k, ptrn):
+        # Equal scores are kept in the order of the index
+        best = heapq.nlargest(k, [(s, -i) for i, s in scores.items()])
+        if len(best) < k:
+            self._remember(("fuzzy", k), ptrn, [-i for _, i in best])
+        return [self._keys[-i] for _, i in best]
+
+    def match(self, ptrn):
+        """Return the item IDs matching ptrn, ordered by priority level
+
+        ptrn (string): The pattern to search for, converted to lower case.
+        """
+
+        ptrn = ptrn.lower()
+        narrowed = None
+        if ptrn != "":
+            narrowed = self._narrowed("match", ptrn)
+        if narrowed is not None and narrowed[0] == ptrn:
+            levels = None
+        elif narrowed is not None:
+            # Only single letters match the authors' initials
+            citekeys, titles = self._citekeys_text[2], self._titles_text[2]
+            levels = [[], [], [], []]
+            for i in narrowed[1]:
+                if citekeys[i].startswith(ptrn):
+                    levels[0].append(i)
+                elif titles[i].startswith(ptrn):
+                    levels[1].append(i)
+                elif ptrn in citekeys[i]:
+                    levels[2].append(i)
+                elif ptrn in titles[i]:
+                    levels[3].append(i)
+        elif ptrn == "":
+            levels = [range(len(self._keys))]
+        else:
+            initials = []
+            for initial in self._initials:
+                if initial.startswith(ptrn):
+                    initials += self._initials[initial]
+            levels = [
+                self._prefix(self._citekeys, ptrn),
+                initials,
+                self._prefix(self._titles, ptrn),
+                self._substring(self._citekeys_text, ptrn),
+                self._substring(self._titles_text, ptrn),
+            ]
+
+        if levels is None:
+            positions = narrowed[1]
+        else:
+            seen = set()
+            positions = []
+            for level in levels:
+                for i in sorted(level):
+                    if i not in seen:
+                        seen.add(i)
+                        positions.append(i)
+            if ptrn != "":
+                self._remember("match", ptrn, positions)
+        return [self._keys[i] for i in positions]
 
 
 class ZoteroEntries:
@@ -36,7 +478,138 @@ class ZoteroEntries:
         "inventor",
     ]
 
+    # CSL equivalents of Zotero's item types, fields and creator types, used
+    # by GetCSL
+    _csl_types = {
+        "artwork": "graphic",
+        "audioRecording": "song",
+        "bill": "bill",
+        "blogPost": "post-weblog",
+        "book": "book",
+        "bookSection": "chapter",
+        "case": "legal_case",
+        "computerProgram": "software",
+        "conferencePaper": "paper-conference",
+        "dataset": "dataset",
+        "dictionaryEntry": "entry-dictionary",
+        "email": "personal_communication",
+        "encyclopediaArticle": "entry-encyclopedia",
+        "film": "motion_picture",
+        "forumPost": "post",
+        "hearing": "bill",
+        "instantMessage": "personal_communication",
+        "interview": "interview",
+        "journalArticle": "article-journal",
+        "letter": "personal_communication",
+        "magazineArticle": "article-magazine",
+        "manuscript": "manuscript",
+        "map": "map",
+        "newspaperArticle": "article-newspaper",
+        "patent": "patent",
+        "podcast": "song",
+        "preprint": "article",
+        "presentation": "speech",
+        "radioBroadcast": "broadcast",
+        "report": "report",
+        "standard": "standard",
+        "statute": "legislation",
+        "thesis": "thesis",
+        "tvBroadcast": "broadcast",
+        "videoRecording": "motion_picture",
+        "webpage": "webpage",
+    }
+    _csl_fields = {
+        "title": "title",
+        "shortTitle": "title-short",
+        "publicationTitle": "container-title",
+        "bookTitle": "container-title",
+        "proceedingsTitle": "container-title",
+        "encyclopediaTitle": "container-title",
+        "dictionaryTitle": "container-title",
+        "websiteTitle": "container-title",
+        "blogTitle": "container-title",
+        "forumTitle": "container-title",
+        "programTitle": "container-title",
+        "journalAbbreviation": "container-title-short",
+        "series": "collection-title",
+        "seriesNumber": "collection-number",
+        "volume": "volume",
+        "numberOfVolumes": "number-of-volumes",
+        "issue": "issue",
+        "pages": "page",
+        "numPages": "number-of-pages",
+        "edition": "edition",
+        "number": "number",
+        "reportNumber": "number",
+        "billNumber": "number",
+        "publisher": "publisher",
+        "university": "publisher",
+        "institution": "publisher",
+        "company": "publisher",
+        "label": "publisher",
+        "studio": "publisher",
+        "distributor": "publisher",
+        "network": "publisher",
+        "place": "publisher-place",
+        "conferenceName": "event-title",
+        "genre": "genre",
+        "thesisType": "genre",
+        "reportType": "genre",
+        "websiteType": "genre",
+        "DOI": "DOI",
+        "ISBN": "ISBN",
+        "ISSN": "ISSN",
+        "url": "URL",
+        "language": "language",
+        "abstractNote": "abstract",
+        "extra": "note",
+        "date": "issued",
+        "issueDate": "issued",
+        "accessDate": "accessed",
+    }
+    _csl_creators = {
+        "author": "author",
+        "bookAuthor": "container-author",
+        "composer": "composer",
+        "director": "director",
+        "editor": "editor",
+        "interviewer": "interviewer",
+        "recipient": "recipient",
+        "reviewedAuthor": "reviewed-author",
+        "seriesEditor": "collection-editor",
+        "translator": "translator",
+    }
+
+    # Citations in markdown documents, as defined by pandoc
+    _citation_regex = re.compile(r"(?<![\w@])@(\w(?:[\w:.#$%&+?<>~/-]*\w)?)")
+
+    # Version of the full text index. Increase it whenever its columns or the
+    # way they are filled change.
+    _fts_version = 1
+    # Zotero fields in the full text index: column of each field
+    _fts_fields = {
+        "title": 0,
+        "publicationTitle": 1,
+        "bookTitle": 1,
+        "proceedingsTitle": 1,
+        "abstractNote": 2,
+    }
+    # Weights of title, publication, abstract, tags, notes, and annotations
+    _fts_weights = (10.0, 2.0, 3.0, 5.0, 1.0, 1.0)
+
+    # Attributes saved in the cache file. Increase _cache_version whenever
+    # their structure changes.
+    _cache_version = 7
+    _cached_attrs = ("_e", "_c", "_deleted", "_zmodified", "_index", "_k")
+
+    _timings = None
+
     def __init__(self):
+        # Record the number and duration of calls of the main methods?
+        if os.getenv("Zotcite_timing") == "1":
+            self._timings = Timings()
+        self._profile = None
+
         # Year-page separator
         if os.getenv("ZYearPageSep") is not None:
             self._ypsep = str(os.getenv("ZYearPageSep"))
@@ -95,21 +668,7 @@ class ZoteroEntries:
                 return None
 
         # Temporary directory
-        if os.getenv("Zotcite_tmpdir") is None:
-            if os.getenv("XDG_CACHE_HOME") and os.path.isdir(
-                str(os.getenv("XDG_CACHE_HOME"))
-            ):
-                self._tmpdir = str(os.getenv("XDG_CACHE_HOME")) + "/zotcite"
-            elif os.getenv("APPDATA") and os.path.isdir(str(os.getenv("APPDATA"))):
-                self._tmpdir = str(os.getenv("APPDATA")) + "/zotcite"
-            elif os.path.isdir(os.path.expanduser("~/.cache")):
-                self._tmpdir = os.path.expanduser("~/.cache/zotcite")
-            elif os.path.isdir(os.path.expanduser("~/Library/Caches")):
-                self._tmpdir = os.path.expanduser("~/Library/Caches/zotcite")
-            else:
-                self._tmpdir = "/tmp/.zotcite"
-        else:
-            self._tmpdir = os.path.expanduser(str(os.getenv("Zotcite_tmpdir")))
+        self._tmpdir = zotcite_tmpdir()
         if not os.path.isdir(self._tmpdir):
             try:
                 os.mkdir(self._tmpdir)
@@ -124,13 +683,111 @@ class ZoteroEntries:
             )
             return None
 
+        # How to read the databases without being blocked by Zotero's locks:
+        # "copy" the files, use SQLite's "backup" API or open them directly
+        # as "immutable".
+        self._copy_method = os.getenv("Zotcite_copy_method", "copy")
+        if self._copy_method not in ("copy", "backup", "immutable"):
+            self._errmsg(
+                'Invalid value of $Zotcite_copy_method: "'
+                + self._copy_method
+                + '". Using "copy".'
+            )
+            self._copy_method = "copy"
+
+        # Profile everything that happens in this thread with cProfile?
+        if os.getenv("Zotcite_profile") == "1":
+            import atexit
+            import cProfile
+
+            self._profile = cProfile.Profile()
+            try:
+                self._profile.enable()
+                atexit.register(self._dump_profile)
+            except ValueError:
+                # Another profiler is running
+                self._profile = None
+
+        # Only reload the items modified since the last load?
+        self._incremental = os.getenv("Zotcite_incremental") != "0"
+
+        # Reload the data in a background thread while the previous data is
+        # still used?
+        self._background = os.getenv("Zotcite_background_reload") == "1"
+        self._reloader = None
+        self._reloaded = None
+        # Number of times the data was reloaded
+        self._generation = 0
+
+        # Convert notes into markdown with html2markdown() or pandoc?
+        self._note_converter = os.getenv("Zotcite_note_converter", "builtin")
+
+        # Rank the matches of GetMatch by fuzzy scores and only return the
+        # best ones?
+        self._fuzzy = os.getenv("Zotcite_completion") == "fuzzy"
+        try:
+            self._max_matches = int(os.getenv("Zotcite_max_matches", "100"))
+        except ValueError:
+            self._errmsg(
+                'Invalid value of $Zotcite_max_matches: "'
+                + str(os.getenv("Zotcite_max_matches"))
+                + '". Using 100.'
+            )
+            self._max_matches = 100
+
+        # Connection used by GetAnnotations and GetNotes
+        self._conn = None
+        self._conn_time = 0
+
+        # Full text index used by FullTextSearch, and the search index of the
+        # data it was last updated with
+        self._fts = None
+        self._fts_of = None
+
+        # How to notice that the databases have changed: "auto" (inotify on
+        # Linux, polling elsewhere), "poll" (check the files every two seconds
+        # in a thread) or "off" (check the files whenever GetMatch is called).
+        self._watcher = None
+        self._watch_seen = 0
+        self._watch_method = os.getenv("Zotcite_watch", "auto")
+        if self._watch_method not in ("auto", "poll", "off"):
+            self._errmsg(
+                'Invalid value of $Zotcite_watch: "'
+                + self._watch_method
+                + '". Using "auto".'
+            )
+            self._watch_method = "auto"
+        if self._watch_method != "off":
+            paths = [self._z, self._z + "-wal", self._b, self._b + "-wal"]
+            if self._watch_method == "poll":
+                self._watcher = PollingWatcher(paths)
+            else:
+                self._watcher = watch(paths)
+
+        # The watcher is started first, so that changes made while the data
+        # is loaded are noticed
         self._c = {}
         self._e = {}
-        self._load_zotero_data()
+        self._deleted = set()
+        if not self._load_cache():
+            self._load_zotero_data()
 
-        # List of collections for each markdown document
+        # List of collections for each markdown document, and search index of
+        # each combination of collections
         self._d = {}
+        self._cindex = {}
+        self._cindex_of = None
+
+        # Completion rows returned by GetMatch, and the search index of the
+        # data they were created from
+        self._rows = {}
+        self._rows_of = None
 
+        # Problems found in each line of each markdown document by
+        # CheckBuffer, and the search index they were found with
+        self._checked = {}
+
+    @_timed
     def SetCollections(self, d, clist):
         """Define which Zotero collections each markdown document uses
 
@@ -146,8 +803,32 @@ class ZoteroEntries:
                     self._d[d].append(c)
                 else:
                     return 'Collection "' + c + '" not found in Zotero database.'
+        self._get_index(d)
         return ""
 
+    def _get_index(self, d):
+        """Return the search index of the references in the collections used
+        by the document d or, if it has none, of all references. The indexes
+        of the collections are rebuilt after the data is reloaded."""
+
+        collections = tuple(sorted(set(self._d.get(d, []))))
+        if not collections:
+            return self._index
+        if self._cindex_of is not self._index:
+            self._cindex = {}
+            self._cindex_of = self._index
+        if collections not in self._cindex:
+            allowed = set()
+            for c in collections:
+                allowed.update(self._c.get(c, ()))
+            if allowed:
+                # Keep the order of the index of all references
+                index = SearchIndex({k: e for k, e in self._e.items() if k in allowed})
+            else:
+                index = self._index
+            self._cindex[collections] = index
+        return self._cindex[collections]
+
     def _get_zotero_prefs(self):
         self._dd = ""
         self._ad = ""
@@ -191,189 +872,507 @@ class ZoteroEntries:
         if self._dd == "" and os.path.isdir(os.path.expanduser("~/Zotero")):
             self._dd = os.path.expanduser("~/Zotero")
 
-    def _copy_zotero_data(self):
-        self._ztime = os.path.getmtime(self._z)
-        zcopy = self._tmpdir + "/copy_of_zotero.sqlite"
-        if os.path.isfile(zcopy):
-            zcopy_time = os.path.getmtime(zcopy)
+    @staticmethod
+    def _db_mtime(path):
+        """Return the modification time of a database and its write-ahead
+        log"""
+        mtime = os.path.getmtime(path)
+        if os.path.isfile(path + "-wal"):
+            mtime = max(mtime, os.path.getmtime(path + "-wal"))
+        return mtime
+
+    def _copy_database(self, src, dst):
+        """Return the name of a database with the contents of src that can
+        be opened with sqlite3.connect(name, uri=True)"""
+
+        if self._copy_method == "immutable":
+            # SQLite will neither lock the file nor check if it has changed
+            return Path(os.path.abspath(src)).as_uri() + "?mode=ro&immutable=1"
+
+        if os.path.isfile(dst):
+            dst_time = os.path.getmtime(dst)
         else:
-            zcopy_time = 0
+            dst_time = 0
+        if self._db_mtime(src) <= dst_time:
+            return dst
+
+        # Write to a temporary file because other Vim instances might be
+        # reading the copy. Its name must be unique, because the thread that
+        # reloads the data in the background might be copying too.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst))
+        os.close(fd)
+        if self._copy_method == "backup":
+            try:
+                source = sqlite3.connect(
+                    Path(os.path.abspath(src)).as_uri() + "?mode=ro", uri=True
+                )
+                target = sqlite3.connect(tmp)
+                # Copy 1024 pages at a time instead of the whole file
+                source.backup(target, pages=1024)
+                target.close()
+                source.close()
+                # The backup has no write-ahead log: a stale one next to the
+                # copy would be applied to it
+                self._remove_wal(dst)
+                os.replace(tmp, dst)
+                return dst
+            except sqlite3.Error:
+                # The database is locked: copy the file
+                if os.path.isfile(tmp):
+                    os.remove(tmp)
+
+        shutil.copyfile(src, tmp)
+        # Recent changes might still be in the write-ahead log, which SQLite
+        # reads if it is next to the copy. A stale log must not be applied
+        # to the new copy.
+        if os.path.isfile(src + "-wal"):
+            shutil.copyfile(src + "-wal", tmp + "-wal")
+            os.replace(tmp + "-wal", dst + "-wal")
+        else:
+            self._remove_wal(dst)
+        os.replace(tmp, dst)
+        return dst
 
+    @staticmethod
+    def _remove_wal(path):
+        """Remove the write-ahead log of the database and its index"""
+        for suffix in ("-wal", "-shm"):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+
+    @_timed
+    def _copy_zotero_data(self):
+        self._ztime = self._db_mtime(self._z)
         # Make a copy of zotero.sqlite to avoid locks
-        if self._ztime > zcopy_time:
-            with open(self._z, "rb") as f:
-                b = f.read()
-            with open(zcopy, "wb") as f:
-                f.write(b)
-        return zcopy
+        return self._copy_database(self._z, self._tmpdir + "/copy_of_zotero.sqlite")
 
+    @_timed
     def _copy_betterbibtex_data(self):
-        self._btime = os.path.getmtime(self._b)
-        bcopy = self._tmpdir + "/copy_of_better_bibtex.sqlite"
-        if os.path.isfile(bcopy):
-            bcopy_time = os.path.getmtime(bcopy)
-        else:
-            bcopy_time = 0
+        self._btime = self._db_mtime(self._b)
+        # Make a copy of better-bibtex.sqlite to avoid locks
+        return self._copy_database(
+            self._b, self._tmpdir + "/copy_of_better_bibtex.sqlite"
+        )
 
-        # Make a copy of zotero.sqlite to avoid locks
-        if self._btime > bcopy_time:
-            with open(self._b, "rb") as f:
-                b = f.read()
-            with open(bcopy, "wb") as f:
-                f.write(b)
-        return bcopy
+    @_timed
+    def _get_connection(self):
+        """Return a read-only connection to zotero.sqlite (or its copy), which
+        is kept open while zotero.sqlite does not change"""
+        ztime = self._db_mtime(self._z)
+        if self._conn is None or ztime != self._conn_time:
+            if self._conn is not None:
+                self._conn.close()
+            # Do not use _copy_zotero_data() because it would update
+            # self._ztime and GetMatch would not reload the references.
+            zcopy = self._copy_database(
+                self._z, self._tmpdir + "/copy_of_zotero.sqlite"
+            )
+            if not zcopy.startswith("file:"):
+                zcopy = Path(os.path.abspath(zcopy)).as_uri() + "?mode=ro"
+            # zotcite_server.py calls the methods from different threads,
+            # but never at the same time
+            self._conn = sqlite3.connect(zcopy, uri=True, check_same_thread=False)
+            self._conn_time = ztime
+        return self._conn
+
+    def _get_zotero_item_id(self, cur, key):
+        """Return the item ID of a key even if it is not a reference's"""
+        k = self._get_item_id(key)
+        if k is not None:
+            return k
+        cur.execute("SELECT itemID FROM items WHERE key = ?", (key,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _get_cache_key(self):
+        zstat = os.stat(self._z)
+        bstat = os.stat(self._b)
+        return (
+            self._cache_version,
+            self._z,
+            self._db_mtime(self._z),
+            zstat.st_size,
+            self._b,
+            self._db_mtime(self._b),
+            bstat.st_size,
+        )
+
+    @_timed
+    def _load_cache(self):
+        """Restore the references saved by a previous session if neither
+        zotero.sqlite nor better-bibtex.sqlite changed since then"""
+        cache = self._tmpdir + "/zotcite_cache.pickle"
+        if not os.path.isfile(cache):
+            return False
+        try:
+            key = self._get_cache_key()
+            with open(cache, "rb") as f:
+                if pickle.load(f) != key:
+                    return False
+                data = pickle.load(f)
+        except Exception:
+            return False
+        for attr in self._cached_attrs:
+            setattr(self, attr, data[attr])
+        self._cache_key = key
+        self._ztime = key[2]
+        self._btime = key[5]
+        self._cbtime = self._btime
+        return True
+
+    @_timed
+    def _save_cache(self):
+        cache = self._tmpdir + "/zotcite_cache.pickle"
+        data = {attr: getattr(self, attr) for attr in self._cached_attrs}
+        try:
+            # Write to a temporary file first because other Vim instances
+            # might be reading the cache
+            with open(cache + str(os.getpid()), "wb") as f:
+                pickle.dump(self._cache_key, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(cache + str(os.getpid()), cache)
+        except OSError:
+            self._exception()
+
+    def _connect_zotero_data(self):
+        # Stat the files before copying them: if they change in the meantime,
+        # the cache will be considered outdated.
+        self._cache_key = self._get_cache_key()
 
-    def _load_zotero_data(self):
         # setup the database
         zcopy = self._copy_zotero_data()
         bcopy = self._copy_betterbibtex_data()
-        conn = sqlite3.connect(zcopy)
+        conn = sqlite3.connect(zcopy, uri=True)
         self._cur = conn.cursor()
         # attach BetterBibTeX database to Zotero database
-        bbt_query = f'ATTACH DATABASE "{bcopy}" as betterbibtex'
-        self._cur.execute(bbt_query)
+        self._cur.execute("ATTACH DATABASE ? as betterbibtex", (bcopy,))
+        return conn
 
+    @_timed
+    def _load_zotero_data(self):
+        conn = self._connect_zotero_data()
+
+        self._e = {}
+        self._get_deleted()
         self._get_collections()
-        self._add_most_fields()
-        self._add_authors()
-        self._add_type()
-        self._add_attachments()
-        self._add_year()
-        self._delete_items()
+        self._select_items()
+        self._add_items()
+        self._build_indexes()
+        self._zmodified = self._get_last_modified()
+        self._cbtime = self._btime
         conn.close()
+        self._save_cache()
+
+    @_timed
+    def _update_zotero_data(self):
+        """Patch self._e and self._c with the items changed since last load"""
+        conn = self._connect_zotero_data()
+
+        self._cur.execute("CREATE TEMP TABLE zchanged (itemID INTEGER PRIMARY KEY)")
+        # Zotero updates clientDateModified on local edits and dateModified
+        # on synced ones. Their resolution is one second, hence ">=".
+        self._cur.execute(
+            """
+            INSERT OR IGNORE INTO temp.zchanged
+            SELECT items.itemID
+            FROM items
+            WHERE
+                items.dateModified >= ?
+                or items.clientDateModified >= ?
+            """,
+            (self._zmodified, self._zmodified),
+        )
+        # Items moved to or restored from the trash
+        deleted = self._deleted
+        self._get_deleted()
+        self._cur.executemany(
+            "INSERT OR IGNORE INTO temp.zchanged VALUES (?)",
+            [(item_id,) for item_id in deleted ^ self._deleted],
+        )
+        # Citation keys changed by Better BibTeX without changes in Zotero
+        if self._btime != self._cbtime:
+            query = """
+                SELECT items.itemID, betterbibtex.citationkey.citationKey
+                FROM items, betterbibtex.citationkey
+                WHERE betterbibtex.citationkey.itemKey = items.key
+                """
+            self._cur.execute(query)
+            self._cur.executemany(
+                "INSERT OR IGNORE INTO temp.zchanged VALUES (?)",
+                [
+                    (item_id,)
+                    for item_id, citekey in self._cur.fetchall()
+                    if item_id not in self._e or self._e[item_id].citekey != citekey
+                ],
+            )
 
+        self._cur.execute("SELECT itemID FROM temp.zchanged")
+        for (item_id,) in self._cur.fetchall():
+            self._e.pop(item_id, None)
+
+        # Items erased from the database (e.g. after emptying the trash)
+        self._cur.execute("SELECT itemID FROM items")
+        existing = {item_id for (item_id,) in self._cur.fetchall()}
+        for item_id in set(self._e) - existing:
+            del self._e[item_id]
+
+        self._get_collections()
+        self._select_items(changed=True)
+        self._add_items()
+        self._build_indexes()
+        self._zmodified = self._get_last_modified()
+        self._cbtime = self._btime
+        conn.close()
+        self._save_cache()
+
+    @_timed
+    def _refresh_zotero_data(self):
+        self._generation += 1
+        if not self._incremental or not self._e:
+            self._load_zotero_data()
+            return
+        try:
+            self._update_zotero_data()
+        except sqlite3.Error:
+            # Unexpected database schema: fall back to a full reload
+            self._load_zotero_data()
+
+    @_timed
+    def _check_zotero_data(self):
+        """Reload the data if zotero.sqlite or better-bibtex.sqlite has
+        changed"""
+        self._use_reloaded_data()
+        # Only stat the files if the watcher has seen them change
+        if self._watcher is not None and self._watcher.changes == self._watch_seen:
+            return
+        if self._reloader is not None and self._reloader.is_alive():
+            # Check again after the running reload finishes
+            return
+        if self._watcher is not None:
+            self._watch_seen = self._watcher.changes
+        if (
+            self._db_mtime(self._z) > self._ztime
+            or self._db_mtime(self._b) > self._btime
+        ):
+            if self._background:
+                self._reload_in_background()
+            else:
+                self._refresh_zotero_data()
+
+    def _reload_in_background(self):
+        # The worker replaces or rebuilds all the data structures except
+        # self._e, whose unchanged entries are shared with the current data.
+        worker = copy.copy(self)
+        worker._e = dict(self._e)
+
+        def reload():
+            try:
+                worker._refresh_zotero_data()
+                self._reloaded = worker
+            except Exception:
+                self._exception()
+
+        self._reloader = threading.Thread(target=reload, daemon=True)
+        self._reloader.start()
+
+    def _use_reloaded_data(self):
+        """Replace the current data with the one loaded in the background.
+        This is done in the main thread, so it is atomic for the callers of
+        the public methods."""
+        worker = self._reloaded
+        if worker is None:
+            return
+        self._reloaded = None
+        for attr in self._cached_attrs + (
+            "_ztime",
+            "_btime",
+            "_cbtime",
+            "_cache_key",
+            "_generation",
+        ):
+            setattr(self, attr, getattr(worker, attr))
+
+    def _get_last_modified(self):
+        self._cur.execute(
+            "SELECT MAX(dateModified), MAX(clientDateModified) FROM items"
+        )
+        dates = [d for d in self._cur.fetchone() if d is not None]
+        if dates:
+            return max(dates)
+        return ""
+
+    @_timed
+    def _build_indexes(self):
+        self._index = SearchIndex(self._e)
+        # Item ID of each Zotero key and citation key
+        self._k = {}
+        for k, e in self._e.items():
+            self._k[e.citekey] = k
+        for k, e in self._e.items():
+            self._k[e.zotkey] = k
+
+    def _get_item_id(self, key):
+        """Return the item ID of either a Zotero key or a citation key"""
+        return self._k.get(key)
+
+    @_timed
+    def _get_deleted(self):
+        self._cur.execute("SELECT itemID FROM deletedItems")
+        self._deleted = {item_id for (item_id,) in self._cur.fetchall()}
+
+    @_timed
     def _get_collections(self):
-        self._c = {}
+        """Store in self._c the item IDs in each collection, including the
+        ones in its subcollections"""
+        self._cur.execute(
+            "SELECT collectionID, collectionName, parentCollectionID FROM collections"
+        )
+        names = {}
+        parents = {}
+        for collection_id, name, parent_id in self._cur.fetchall():
+            names[collection_id] = name
+            parents[collection_id] = parent_id
+        items = {collection_id: set() for collection_id in names}
         query = """
-            SELECT collections.collectionName
-            FROM collections
+            SELECT collectionItems.collectionID, collectionItems.itemID
+            FROM collectionItems
+            WHERE collectionItems.itemID NOT IN (SELECT itemID FROM deletedItems)
             """
         self._cur.execute(query)
-        for (c,) in self._cur.fetchall():
-            self._c[c] = []
-        query = """
-            SELECT items.itemID, collections.collectionName
-            FROM items, collections, collectionItems
+        for collection_id, item_id in self._cur.fetchall():
+            if collection_id in items:
+                items[collection_id].add(item_id)
+
+        self._c = {name: set() for name in names.values()}
+        for collection_id, collection_items in items.items():
+            # Add the items to the collection and to all its ancestors
+            seen = set()
+            while collection_id in names and collection_id not in seen:
+                seen.add(collection_id)
+                self._c[names[collection_id]].update(collection_items)
+                collection_id = parents[collection_id]
+
+    @_timed
+    def _select_items(self, changed=False):
+        """Store in temp.zitems the references to be (re)loaded: items with a
+        Better BibTeX citation key that are neither attachments nor in the
+        trash, restricted to the ones in temp.zchanged if changed is True"""
+
+        if changed:
+            # The "+" keeps SQLite from probing the index of items with the
+            # whole list of changed items for each citation key, which takes
+            # seconds when thousands of items changed
+            restrict = "and +items.itemID IN (SELECT itemID FROM temp.zchanged)"
+        else:
+            restrict = ""
+        self._cur.execute(
+            """
+            CREATE TEMP TABLE zitems (
+                itemID INTEGER PRIMARY KEY, key TEXT, citekey TEXT, etype TEXT
+            )
+            """
+        )
+        query = f"""
+            INSERT INTO temp.zitems
+            SELECT items.itemID, items.key, betterbibtex.citationkey.citationKey, itemTypes.typeName
+            FROM items, itemTypes, betterbibtex.citationkey
             WHERE
-                items.itemID = collectionItems.itemID
-                and collections.collectionID = collectionItems.collectionID
-            ORDER by collections.collectionName != "To Read",
-                collections.collectionName
+                items.itemTypeID = itemTypes.itemTypeID
+                and betterbibtex.citationkey.itemKey = items.key
+                and itemTypes.typeName != "attachment"
+                and items.itemID NOT IN (SELECT itemID FROM deletedItems)
+                {restrict}
             """
         self._cur.execute(query)
-        for item_id, item_collection in self._cur.fetchall():
-            self._c[item_collection].append(item_id)
 
-    def _add_most_fields(self):
+    @_timed
+    def _add_items(self):
+        """Add to self._e the items selected in temp.zitems"""
+
+        e = self._e
+        self._cur.execute("SELECT itemID, key, citekey, etype FROM temp.zitems")
+        for item_id, item_key, citekey, etype in self._cur:
+            e[item_id] = Entry(item_key, citekey, etype)
+
+        # The year comes from the date or, if there is no date, from the
+        # issue date
         query = """
-            SELECT items.itemID, items.key, fields.fieldName, itemDataValues.value, betterbibtex.citationkey.citationKey
-            FROM items, itemData, fields, itemDataValues, betterbibtex.citationkey
+            SELECT itemData.itemID, fields.fieldName, itemDataValues.value
+            FROM temp.zitems AS zitems, itemData, fields, itemDataValues
             WHERE
-                items.itemID = itemData.itemID
+                zitems.itemID = itemData.itemID
                 and itemData.fieldID = fields.fieldID
                 and itemData.valueID = itemDataValues.valueID
-                and betterbibtex.citationkey.itemKey = items.key
+                and fields.fieldName IN ('title', 'date', 'issueDate')
             """
-        self._e = {}
         self._cur.execute(query)
-        for item_id, item_key, field, value, citekey in self._cur.fetchall():
-            if item_id not in self._e:
-                self._e[item_id] = {
-                    "zotkey": item_key,
-                    "alastnm": "",
-                    "citekey": citekey,
-                }
-            self._e[item_id][field] = value
-
-        for k in self._e:
-            if "title" not in self._e[k]:
-                self._e[k]["title"] = ""
-
-    def _add_authors(self):
+        dated = set()
+        for item_id, field, value in self._cur:
+            if field == "title":
+                e[item_id].title = value
+            elif field == "date" or item_id not in dated:
+                if field == "date":
+                    dated.add(item_id)
+                e[item_id].year = sys.intern(value.split(" ")[0].split("-")[0])
+
         query = """
-            SELECT items.itemID, creatorTypes.creatorType, creators.lastName, creators.firstName
-            FROM items, itemCreators, creators, creatorTypes
+            SELECT itemCreators.itemID, creatorTypes.creatorType, creators.lastName
+            FROM temp.zitems AS zitems, itemCreators, creators, creatorTypes
             WHERE
-                items.itemID = itemCreators.itemID
+                zitems.itemID = itemCreators.itemID
                 and itemCreators.creatorID = creators.creatorID
-                and creators.creatorID = creators.creatorID
                 and itemCreators.creatorTypeID = creatorTypes.creatorTypeID
-            ORDER by itemCreators.ORDERIndex
+            ORDER BY itemCreators.itemID, itemCreators.orderIndex
             """
         self._cur.execute(query)
-        for item_id, ctype, lastname, firstname in self._cur.fetchall():
-            if item_id in self._e:
-                if ctype in self._e[item_id]:
-                    self._e[item_id][ctype] += [[lastname, firstname]]
-                else:
-                    self._e[item_id][ctype] = [[lastname, firstname]]
-                # Special field for citation seeking
-                if ctype == "author":
-                    self._e[item_id]["alastnm"] += ", " + lastname
-                else:
-                    sought = ["author"]
-                    for c in self._creators:
-                        if ctype == c:
-                            flag = False
-                            for s in sought:
-                                if s in self._e[item_id]:
-                                    flag = True
-                                    break
-                            if not flag:
-                                self._e[item_id]["alastnm"] += ", " + lastname
-                        sought.append(c)
-
-    def _add_type(self):
-        query = """
-            SELECT items.itemID, itemTypes.typeName
-            FROM items, itemTypes
-            WHERE
-                items.itemTypeID = itemTypes.itemTypeID
+        # Special field for citation seeking: last names of the authors or,
+        # if there is no author, of the first kind of creator in
+        # self._creators found in the item.
+        priority = {c: i + 1 for i, c in enumerate(self._creators)}
+        priority["author"] = 0
+        alastnm = {}
+        last_id = None
+        for item_id, ctype, lastname in self._cur:
+            if item_id != last_id:
+                last_id = item_id
+                best = len(priority)
+                names = alastnm[item_id] = []
+            if ctype in priority and priority[ctype] <= best:
+                best = priority[ctype]
+                names.append(lastname)
+        for item_id, names in alastnm.items():
+            # The same authors are found in many references
+            e[item_id].alastnm = sys.intern(", ".join(names))
+
+    def _get_attachments(self, cur, item_id):
+        """Return the attachments of an item as "key:path" strings"""
+        cur.execute(
             """
-        self._cur.execute(query)
-        for item_id, item_type in self._cur.fetchall():
-            if item_id in self._e:
-                if item_type == "attachment":
-                    del self._e[item_id]
-                else:
-                    self._e[item_id]["etype"] = item_type
-
-    def _add_attachments(self):
-        query = """
-            SELECT items.key, itemAttachments.parentItemID, itemAttachments.path
-            FROM items, itemAttachments
-            WHERE items.itemID = itemAttachments.itemID
-            """
-        self._cur.execute(query)
-        for pKey, pId, aPath in self._cur.fetchall():
-            if pId in self._e and not pKey is None and not aPath is None:
-                if "attachment" in self._e[pId]:
-                    self._e[pId]["attachment"].append(pKey + ":" + aPath)
-                else:
-                    self._e[pId]["attachment"] = [pKey + ":" + aPath]
-
-    def _add_year(self):
-        for k in self._e:
-            if "date" in self._e[k]:
-                year = re.sub(" .*", "", self._e[k]["date"]).split("-")[0]
-            else:
-                if "issueDate" in self._e[k]:
-                    year = re.sub(" .*", "", self._e[k]["issueDate"]).split("-")[0]
-                else:
-                    year = ""
-            self._e[k]["year"] = year
-
-    def _delete_items(self):
-        self._cur.execute("SELECT itemID FROM deletedItems")
-        for (item_id,) in self._cur.fetchall():
-            if item_id in self._e:
-                del self._e[item_id]
-            for c in self._c:
-                if item_id in self._c[c]:
-                    self._c[c].remove(item_id)
+            SELECT items.key, itemAttachments.path
+            FROM itemAttachments, items
+            WHERE
+                itemAttachments.parentItemID = ?
+                and items.itemID = itemAttachments.itemID
+                and items.key IS NOT NULL
+                and itemAttachments.path IS NOT NULL
+            ORDER BY itemAttachments.itemID
+            """,
+            (item_id,),
+        )
+        return [att_key + ":" + att_path for att_key, att_path in cur.fetchall()]
 
-        for k in self._e:
-            self._e[k]["alastnm"] = re.sub("^, ", "", self._e[k]["alastnm"])
+    def _dump_profile(self):
+        """Save the statistics collected by cProfile in a file that can be
+        read with the pstats module and return its path"""
+        path = os.path.join(self._tmpdir, "zotcite_profile.prof")
+        # dump_stats() stops the profiler
+        self._profile.dump_stats(path)
+        self._profile.enable()
+        return path
 
     @classmethod
     def _errmsg(cls, msg):
@@ -387,17 +1386,15 @@ class ZoteroEntries:
         lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
         self._errmsg("Zotcite error: " + "".join(line for line in lines))
 
-    # @classmethod
-    def _get_compl_line(self, e):
-        alastnm = e["alastnm"]
-        key = e["citekey"]
-        if alastnm == "":
-            lst = [key, "", "(" + e["year"] + ") " + e["title"]]
-        else:
-            if len(alastnm) > 40:
-                alastnm = alastnm[:40] + "…"
-            lst = [key, alastnm, "(" + e["year"] + ") " + e["title"]]
-        return lst
+    def _get_compl_row(self, k):
+        """Return the completion row of a reference, creating it the first
+        time the reference is matched after the data is loaded"""
+        e = self._e[k]
+        alastnm = e.alastnm
+        if len(alastnm) > 40:
+            alastnm = alastnm[:40] + "…"
+        row = self._rows[k] = [e.citekey, alastnm, e.year, e.title]
+        return row
 
     @staticmethod
     def _sanitize_markdown(s):
@@ -408,80 +1405,100 @@ class ZoteroEntries:
         s = s.replace("_", "\\_")
         return s
 
-    def GetMatch(self, ptrn, d):
-        """Find citation key and save completion lines in temporary file
+    @_timed
+    def GetMatch(self, ptrn, d, limit=0):
+        """Return the references matching the pattern as [citation key,
+        authors' last names, year, title] lists, which must not be modified
 
         ptrn (string): The pattern to search for, converted to lower case.
         d    (string): The name of the markdown document.
+        limit   (int): If greater than 0, the maximum number of references.
         """
-        if os.path.getmtime(self._z) > self._ztime:
-            self._load_zotero_data()
+        self._check_zotero_data()
 
-        if d in self._d and self._d[d]:
-            collections = self._d[d]
-            keys = []
-            for c in collections:
-                if c in self._c:
-                    keys += self._c[c]
-            if keys == []:
-                keys = self._e.keys()
+        index = self._get_index(d)
+        if self._fuzzy:
+            keys = index.fuzzy(ptrn, self._max_matches)
         else:
-            keys = self._e.keys()
-
-        # priority level
-        p1 = []
-        p2 = []
-        p3 = []
-        p4 = []
-        p5 = []
-        p6 = []
-        ptrn = ptrn.lower()
-        for k in keys:
-            if self._e[k]["citekey"].lower().find(ptrn) == 0:
-                p1.append(self._get_compl_line(self._e[k]))
-            elif (
-                self._e[k]["alastnm"]
-                and self._e[k]["alastnm"][0][0].lower().find(ptrn) == 0
-            ):
-                p2.append(self._get_compl_line(self._e[k]))
-            elif self._e[k]["title"].lower().find(ptrn) == 0:
-                p3.append(self._get_compl_line(self._e[k]))
-            elif self._e[k]["citekey"].lower().find(ptrn) > 0:
-                p4.append(self._get_compl_line(self._e[k]))
-            elif (
-                self._e[k]["alastnm"]
-                and self._e[k]["alastnm"][0][0].lower().find(ptrn) > 0
-            ):
-                p5.append(self._get_compl_line(self._e[k]))
-            elif self._e[k]["title"].lower().find(ptrn) > 0:
-                p6.append(self._get_compl_line(self._e[k]))
-        resp = p1 + p2 + p3 + p4 + p5 + p6
-        return resp
-
+            keys = index.match(ptrn)
+        if limit > 0:
+            keys = keys[:limit]
+        return self._get_compl_rows(keys)
+
+    def _get_compl_rows(self, keys):
+        if self._rows_of is not self._index:
+            self._rows = {}
+            self._rows_of = self._index
+        rows = self._rows
+        return [rows[k] if k in rows else self._get_compl_row(k) for k in keys]
+
+    @_timed
     def GetAttachment(self, zotkey):
         """Tell Vim what attachment is associated with the citation key
 
         zotkey  (string): The Zotero key as it appears in the markdown document.
         """
 
-        for k in self._e:
-            if zotkey in [self._e[k]["zotkey"], self._e[k]["citekey"]]:
-                if "attachment" in self._e[k]:
-                    return self._e[k]["attachment"]
-                return ["nOaTtAChMeNt"]
-        return ["nOcItEkEy"]
+        k = self._get_item_id(zotkey)
+        if k is None:
+            return ["nOcItEkEy"]
+        attachments = self._get_attachments(self._get_connection().cursor(), k)
+        if attachments:
+            return attachments
+        return ["nOaTtAChMeNt"]
 
+    @_timed
     def GetRefData(self, zotkey):
         """Return the key's dictionary.
 
         zotkey  (string): The Zotero key as it appears in the markdown document.
         """
 
-        for k in self._e:
-            if zotkey in [self._e[k]["zotkey"], self._e[k]["citekey"]]:
-                return self._e[k]
-        return {}
+        k = self._get_item_id(zotkey)
+        if k is None:
+            return {}
+        e = self._e[k]
+        ref = {
+            "zotkey": e.zotkey,
+            "alastnm": e.alastnm,
+            "citekey": e.citekey,
+            "etype": e.etype,
+        }
 
+        # Fields that are not kept in memory
+        cur = self._get_connection().cursor()
+        query = """
+            SELECT fields.fieldName, itemDataValues.value
+            FROM itemData, fields, itemDataValues
+            WHERE
+                itemData.itemID = ?
+                and itemData.fieldID = fields.fieldID
+                and itemData.valueID = itemDataValues.valueID
+            """
+        cur.execute(query, (k,))
+        for field, value in cur.fetchall():
+            ref[field] = value
+        query = """
+            SELECT creatorTypes.creatorType, creators.lastName, creators.firstName
+            FROM itemCreators, creators, creatorTypes
+            WHERE
+                itemCreators.itemID = ?
+                and itemCreators.creatorID = creators.creatorID
+                and itemCreators.creatorTypeID = creatorTypes.creatorTypeID
+            ORDER BY itemCreators.orderIndex
+            """
+        cur.execute(query, (k,))
+        for ctype, lastname, firstname in cur.fetchall():
+            ref.setdefault(ctype, []).append([lastname, firstname])
+        attachments = self._get_attachments(cur, k)
+        if attachments:
+            ref["attachment"] = attachments
+
+        ref.setdefault("title", "")
+        ref["year"] = e.year
+        return ref
+
+    @_timed
     def GetCitationById(self, Id):
         """Return the complete citation string.
 
@@ -489,59 +1506,413 @@ class ZoteroEntries:
         """
 
         if Id in self._e.keys():
-            return "@" + self._e[Id]["zotkey"] + "#" + self._e[Id]["citekey"]
+            return "@" + self._e[Id].zotkey + "#" + self._e[Id].citekey
         return "IdNotFound"
 
-    def GetAnnotations(self, key, offset):
-        """Return user annotations made using Zotero's PDF viewer.
+    def _resolve(self, key):
+        """Return the item ID of a citation written either as zotkey#citekey
+        or as a single Zotero key or citation key"""
+        zotkey, _, citekey = key.partition("#")
+        k = self._k.get(zotkey)
+        if k is None and citekey:
+            k = self._k.get(citekey)
+        return k
 
-        key (string): The Zotero key as it appears in the markdown document.
+    @staticmethod
+    def _csl_date(value):
+        # Zotero stores dates as "2020-03-00 March 2020"
+        m = re.match(r"(\d{4})-(\d\d)-(\d\d)", value)
+        if m is None:
+            return {"literal": value}
+        parts = [int(m.group(1))]
+        for p in (int(m.group(2)), int(m.group(3))):
+            if p == 0:
+                break
+            parts.append(p)
+        return {"date-parts": [parts]}
+
+    @_timed
+    def GetCSL(self, keys):
+        """Return the CSL JSON data of the cited references as a dictionary
+        whose keys are the citations that were found. The "id" of each
+        reference is its citation key.
+
+        keys (list): Citations written either as zotkey#citekey or as a single
+                     Zotero key or citation key.
         """
-        zcopy = self._copy_zotero_data()
-        conn = sqlite3.connect(zcopy)
-        cur = conn.cursor()
 
-        query = (
-            """
-            SELECT items.key, itemAttachments.ItemID, itemAttachments.parentItemID, itemAnnotations.parentItemID, itemAnnotations.type, itemAnnotations.authorName, itemAnnotations.text, itemAnnotations.comment, itemAnnotations.pageLabel
-            FROM items, itemAttachments, itemAnnotations
-            WHERE items.key = '"""
-            + key
-            + """'
-            and items.itemID = itemAttachments.parentItemID
+        self._check_zotero_data()
+
+        ids = {}
+        for key in keys:
+            k = self._resolve(key)
+            if k is not None:
+                ids[key] = k
+        items = {}
+        for k in set(ids.values()):
+            e = self._e[k]
+            items[k] = {
+                "id": e.citekey,
+                "type": self._csl_types.get(e.etype, "document"),
+            }
+        if not items:
+            return {}
+
+        cur = self._get_connection().cursor()
+        item_ids = list(items)
+        # Stay below SQLite's limit of variables per query
+        for start in range(0, len(item_ids), 500):
+            chunk = item_ids[start : start + 500]
+            marks = ",".join("?" * len(chunk))
+            query = f"""
+                SELECT itemData.itemID, fields.fieldName, itemDataValues.value
+                FROM itemData, fields, itemDataValues
+                WHERE
+                    itemData.itemID IN ({marks})
+                    and itemData.fieldID = fields.fieldID
+                    and itemData.valueID = itemDataValues.valueID
+                """
+            cur.execute(query, chunk)
+            for item_id, field, value in cur.fetchall():
+                var = self._csl_fields.get(field)
+                if var is None:
+                    continue
+                item = items[item_id]
+                if var in ("issued", "accessed"):
+                    # The date takes precedence over the issue date
+                    if field == "issueDate" and var in item:
+                        continue
+                    value = self._csl_date(value)
+                item[var] = value
+            query = f"""
+                SELECT itemCreators.itemID, creatorTypes.creatorType,
+                    creators.lastName, creators.firstName, creators.fieldMode
+                FROM itemCreators, creators, creatorTypes
+                WHERE
+                    itemCreators.itemID IN ({marks})
+                    and itemCreators.creatorID = creators.creatorID
+                    and itemCreators.creatorTypeID = creatorTypes.creatorTypeID
+                ORDER BY itemCreators.itemID, itemCreators.orderIndex
+                """
+            cur.execute(query, chunk)
+            for item_id, ctype, lastname, firstname, fieldmode in cur.fetchall():
+                var = self._csl_creators.get(ctype)
+                if var is None:
+                    continue
+                if fieldmode == 1:
+                    name = {"literal": lastname}
+                elif firstname:
+                    name = {"family": lastname, "given": firstname}
+                else:
+                    name = {"family": lastname}
+                items[item_id].setdefault(var, []).append(name)
+        return {key: items[k] for key, k in ids.items()}
+
+    def _check(self, key):
+        k = self._resolve(key)
+        if k is None:
+            return {
+                "key": key,
+                "found": False,
+                "changed": False,
+                "zotkey": "",
+                "citekey": "",
+            }
+        e = self._e[k]
+        zotkey, sep, citekey = key.partition("#")
+        return {
+            "key": key,
+            "found": True,
+            "changed": bool(sep) and (zotkey != e.zotkey or citekey != e.citekey),
+            "zotkey": e.zotkey,
+            "citekey": e.citekey,
+        }
+
+    @_timed
+    def CheckCitations(self, keys):
+        """Return a dictionary for each citation telling whether it was found,
+        whether its Zotero key and its citation key disagree (for example,
+        because Better BibTeX changed the citation key), and the current
+        Zotero key and citation key of the reference.
+
+        keys (list): Citations written either as zotkey#citekey or as a single
+                     Zotero key or citation key, with or without the "@".
+        """
+
+        self._check_zotero_data()
+        return [self._check(re.sub("^@", "", key)) for key in keys]
+
+    def _check_line(self, line):
+        problems = []
+        if "@" not in line:
+            return problems
+        for m in self._citation_regex.finditer(line):
+            c = self._check(m.group(1))
+            if not c["found"]:
+                problem = ["missing", ""]
+            elif c["changed"]:
+                problem = ["changed", c["zotkey"] + "#" + c["citekey"]]
+            else:
+                continue
+            # Vim's columns are counted in bytes
+            col = len(line[: m.start()].encode("utf-8")) + 1
+            problems.append([col, m.group(1)] + problem)
+        return problems
+
+    @_timed
+    def CheckBuffer(self, d, lines):
+        """Return the citations of a markdown document that were not found or
+        whose citation key changed as [line, column, citation, "missing" or
+        "changed", corrected citation] lists. Lines that did not change since
+        the previous call for the same document are not checked again, unless
+        the Zotero data was reloaded.
+
+        d     (string): The name of the markdown document.
+        lines   (list): The lines of the document.
+        """
+
+        self._check_zotero_data()
+
+        old = {}
+        if d in self._checked and self._checked[d][0] is self._index:
+            old = self._checked[d][1]
+        checked = {}
+        resp = []
+        for lnum, line in enumerate(lines, 1):
+            if line not in checked:
+                if line in old:
+                    checked[line] = old[line]
+                else:
+                    checked[line] = self._check_line(line)
+            for problem in checked[line]:
+                resp.append([lnum] + problem)
+        self._checked[d] = (self._index, checked)
+        return resp
+
+    def _get_fts(self):
+        """Return the connection to the full text index, creating it if
+        necessary"""
+        if self._fts is None:
+            conn = sqlite3.connect(
+                self._tmpdir + "/zotcite_fts.sqlite",
+                timeout=10,
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value)"
+            )
+            state = dict(conn.execute("SELECT name, value FROM state"))
+            if state.get("version") != self._fts_version or state.get(
+                "zotero.sqlite"
+            ) != os.path.abspath(self._z):
+                conn.execute("DROP TABLE IF EXISTS refs")
+                conn.execute("DELETE FROM state")
+                conn.executemany(
+                    "INSERT INTO state VALUES (?, ?)",
+                    [
+                        ("version", self._fts_version),
+                        ("zotero.sqlite", os.path.abspath(self._z)),
+                    ],
+                )
+            conn.execute(
+                """
+                CREATE VIRTUAL TABLE IF NOT EXISTS refs USING fts5(
+                    title, publication, abstract, tags, notes, annotations,
+                    tokenize = 'unicode61 remove_diacritics 2'
+                )
+                """
+            )
+            conn.commit()
+            self._fts = conn
+        return self._fts
+
+    def _get_fts_texts(self, cur, ids):
+        """Return the text of each column of the full text index for the
+        items"""
+        texts = {k: ["", "", "", [], [], []] for k in ids}
+        ids = list(ids)
+        # Stay below SQLite's limit of variables per query
+        for start in range(0, len(ids), 500):
+            chunk = ids[start : start + 500]
+            marks = ",".join("?" * len(chunk))
+            cur.execute(
+                f"""
+                SELECT itemData.itemID, fields.fieldName, itemDataValues.value
+                FROM itemData, fields, itemDataValues
+                WHERE
+                    itemData.itemID IN ({marks})
+                    and itemData.fieldID = fields.fieldID
+                    and itemData.valueID = itemDataValues.valueID
+                    and fields.fieldName IN ({",".join("?" * len(self._fts_fields))})
+                """,
+                chunk + list(self._fts_fields),
+            )
+            for item_id, field, value in cur.fetchall():
+                texts[item_id][self._fts_fields[field]] = value
+            cur.execute(
+                f"""
+                SELECT itemTags.itemID, tags.name
+                FROM itemTags, tags
+                WHERE itemTags.itemID IN ({marks}) and itemTags.tagID = tags.tagID
+                """,
+                chunk,
+            )
+            for item_id, tag in cur.fetchall():
+                texts[item_id][3].append(tag)
+            cur.execute(
+                self._notes_query(f"itemNotes.parentItemID IN ({marks})"), chunk
+            )
+            for item_id, note in cur.fetchall():
+                note = html.unescape(re.sub("<[^>]*>", " ", note or ""))
+                texts[item_id][4].append(note)
+            cur.execute(
+                self._annotations_query(f"itemAttachments.parentItemID IN ({marks})"),
+                chunk,
+            )
+            for item_id, text, comment, _ in cur.fetchall():
+                texts[item_id][5] += [t for t in (text, comment) if t]
+        for t in texts.values():
+            for i in (3, 4, 5):
+                t[i] = "\n".join(t[i])
+        return texts
+
+    @_timed
+    def _update_fts(self):
+        """Update the full text index with the items changed since its last
+        update"""
+        if self._fts_of is self._index:
+            return
+        fts = self._get_fts()
+        cur = self._get_connection().cursor()
+        modified = dict(fts.execute("SELECT name, value FROM state")).get("modified")
+        cur.execute("SELECT MAX(dateModified), MAX(clientDateModified) FROM items")
+        dates = [d for d in cur.fetchone() if d is not None]
+
+        indexed = {k for (k,) in fts.execute("SELECT rowid FROM refs")}
+        changed = set(self._e) - indexed
+        if modified is not None:
+            # Changed items, and the references of changed notes, attachments
+            # and annotations. Zotero's dates have a resolution of one second,
+            # hence ">=".
+            cur.execute(
+                """
+                WITH changed AS (
+                    SELECT itemID FROM items
+                    WHERE dateModified >= ? or clientDateModified >= ?
+                )
+                SELECT itemID FROM changed
+                UNION SELECT itemNotes.parentItemID FROM itemNotes
+                    WHERE itemNotes.itemID IN changed
+                UNION SELECT itemAttachments.parentItemID FROM itemAttachments
+                    WHERE itemAttachments.itemID IN changed
+                UNION SELECT itemAttachments.parentItemID
+                    FROM itemAttachments, itemAnnotations
+                    WHERE
+                        itemAnnotations.itemID IN changed
+                        and itemAttachments.itemID = itemAnnotations.parentItemID
+                """,
+                (modified, modified),
+            )
+            changed |= {k for (k,) in cur.fetchall() if k in indexed}
+        changed &= set(self._e)
+        removed = indexed - set(self._e)
+
+        with fts:
+            fts.executemany(
+                "DELETE FROM refs WHERE rowid = ?", [(k,) for k in changed | removed]
+            )
+            texts = self._get_fts_texts(cur, changed)
+            fts.executemany(
+                "INSERT INTO refs (rowid, title, publication, abstract, tags, notes,"
+                " annotations) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [[k] + t for k, t in texts.items()],
+            )
+            fts.execute(
+                "INSERT OR REPLACE INTO state VALUES ('modified', ?)",
+                (max(dates) if dates else "",),
+            )
+        self._fts_of = self._index
+
+    @_timed
+    def FullTextSearch(self, query, limit=100):
+        """Return the references whose title, publication, abstract, tags,
+        notes or annotations contain all words of the query, the most
+        relevant first, as [citation key, authors' last names, year, title]
+        lists, like GetMatch
+
+        query (string): Words to search for. The last one might be incomplete.
+        limit    (int): The maximum number of references.
+        """
+
+        self._check_zotero_data()
+        self._update_fts()
+
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+        match = " ".join('"' + w + '"' for w in words) + "*"
+        weights = ", ".join(str(w) for w in self._fts_weights)
+        keys = [
+            k
+            for (k,) in self._get_fts().execute(
+                f"SELECT rowid FROM refs WHERE refs MATCH ?"
+                f" ORDER BY bm25(refs, {weights}) LIMIT ?",
+                (match, limit),
+            )
+            if k in self._e
+        ]
+        return self._get_compl_rows(keys)
+
+    def _annotations_query(self, restrict):
+        return f"""
+            SELECT itemAttachments.parentItemID, itemAnnotations.text, itemAnnotations.comment, itemAnnotations.pageLabel
+            FROM itemAttachments, itemAnnotations
+            WHERE {restrict}
             and itemAnnotations.parentItemID = itemAttachments.ItemID
             """
-        )
-        cur.execute(query)
+
+    def _notes_query(self, restrict):
+        return f"""
+                SELECT itemNotes.parentItemID, itemNotes.note
+                FROM itemNotes
+                WHERE
+                    {restrict}
+                    and itemNotes.itemID NOT IN (SELECT itemID FROM deletedItems)
+                ORDER BY itemNotes.itemID
+                """
+
+    def _format_annotations(self, rows, key, offset):
+        """Convert rows of (text, comment, pageLabel) into markdown lines"""
 
         citekey = ""
-        for k in self._e:
-            if key in [self._e[k]["zotkey"], self._e[k]["citekey"]]:
-                citekey = self._e[k]["citekey"]
+        k = self._get_item_id(key)
+        if k is not None:
+            citekey = self._e[k].citekey
 
         notes = []
-        for i in cur.fetchall():
-            mo = re.match("^[0-9]*$", i[8])
-            if mo is not None and mo.string == i[8]:
-                page = str(int(i[8]) + offset)
+        for text, comment, page_label in rows:
+            mo = re.match("^[0-9]*$", page_label)
+            if mo is not None and mo.string == page_label:
+                page = str(int(page_label) + offset)
             else:
-                page = i[8]
-            if i[7]:  # Comment
+                page = page_label
+            if comment:
                 notes.append("")
-                if i[7].find("\n") > -1:
-                    ss = i[7].split("\n")
+                if comment.find("\n") > -1:
+                    ss = comment.split("\n")
                     for s in ss:
                         notes.append(s)
                     notes.append(" [@" + key + "#" + citekey + self._ypsep + page + "]")
                 else:
                     notes.append(
-                        i[7] + " [@" + key + "#" + citekey + self._ypsep + page + "]"
+                        comment + " [@" + key + "#" + citekey + self._ypsep + page + "]"
                     )
-            if i[6]:  # Highlighted text
+            if text:  # Highlighted text
                 notes.append("")
                 notes.append(
                     "> "
-                    + self._sanitize_markdown(i[6])
+                    + self._sanitize_markdown(text)
                     + " [@"
                     + key
                     + "#"
@@ -552,56 +1923,28 @@ class ZoteroEntries:
                 )
         return notes
 
-    def GetNotes(self, key):
-        """Return user notes from a reference.
+    @_timed
+    def GetAnnotations(self, key, offset):
+        """Return user annotations made using Zotero's PDF viewer.
 
         key (string): The Zotero key as it appears in the markdown document.
         """
-        zcopy = self._copy_zotero_data()
-        conn = sqlite3.connect(zcopy)
-        cur = conn.cursor()
-
-        query = """
-                SELECT items.itemID, items.key
-                FROM items
-                """
-        cur.execute(query)
-
-        key_id = ""
-        for item_id, item_key in cur.fetchall():
-            if item_key == key:
-                key_id = item_id
-                break
+        cur = self._get_connection().cursor()
+        query = self._annotations_query("itemAttachments.parentItemID = ?")
+        cur.execute(query, (self._get_zotero_item_id(cur, key),))
+        return self._format_annotations([r[1:] for r in cur.fetchall()], key, offset)
 
-        cur.execute("SELECT itemID FROM deletedItems")
-        zdel = []
-        for (item_id,) in cur.fetchall():
-            zdel.append(item_id)
-
-        query = """
-                SELECT itemNotes.itemID, itemNotes.parentItemID, itemNotes.note
-                FROM itemNotes
-                WHERE
-                    itemNotes.parentItemID IS NOT NULL;
-                """
-        cur.execute(query)
-        notes = ""
-        for item_id, item_pId, item_note in cur.fetchall():
-            if item_pId == key_id and not item_id in zdel:
-                notes += item_note
-
-        conn.close()
-
-        if notes == "":
-            return ""
+    def _prepare_notes(self, notes):
+        """Replace Zotero's citations in the HTML of notes with markers that
+        pandoc will not escape"""
 
         def key2ref(k):
             k = re.sub("\001", "", k)
             k = re.sub("\002", "", k)
             r = "NotFound"
-            for i in self._e:
-                if k in [self._e[i]["zotkey"], self._e[i]["citekey"]]:
-                    r = self._e[i]["citekey"]
+            i = self._get_item_id(k)
+            if i is not None:
+                r = self._e[i].citekey
             return "\001" + k + "#" + r + "; "
 
         def item2ref(s):
@@ -630,14 +1973,11 @@ class ZoteroEntries:
             notes,
             flags=re.M,
         )
+        return notes
 
-        p = subprocess.Popen(
-            ["pandoc", "-f", "html", "-t", "markdown"],
-            stdout=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-        )
-        notes = p.communicate(notes.encode("utf-8"))[0]
-        notes = notes.decode()
+    @staticmethod
+    def _finish_notes(notes):
+        """Restore the citations and fix the markdown produced by pandoc"""
 
         notes = re.sub("\001", "@", notes, flags=re.M)
         notes = re.sub("\002", "[", notes, flags=re.M)
@@ -656,9 +1996,151 @@ class ZoteroEntries:
 
         return notes + "\n"
 
+    @staticmethod
+    def _pandoc():
+        return subprocess.Popen(
+            ["pandoc", "-f", "html", "-t", "markdown"],
+            stdout=subprocess.PIPE,
+            stdin=subprocess.PIPE,
+        )
+
+    @_timed
+    def GetNotes(self, key):
+        """Return user notes from a reference.
+
+        key (string): The Zotero key as it appears in the markdown document.
+        """
+        cur = self._get_connection().cursor()
+        query = self._notes_query("itemNotes.parentItemID = ?")
+        cur.execute(query, (self._get_zotero_item_id(cur, key),))
+        notes = ""
+        for _, item_note in cur.fetchall():
+            notes += item_note
+
+        if notes == "":
+            return ""
+
+        notes = self._prepare_notes(notes)
+        if self._note_converter == "builtin":
+            try:
+                return self._finish_notes(html2markdown(notes))
+            except UnsupportedHTML:
+                pass
+        p = self._pandoc()
+        notes = p.communicate(notes.encode("utf-8"))[0]
+        notes = notes.decode()
+        return self._finish_notes(notes)
+
+    # Paragraph separating the notes of different references in the input of
+    # pandoc
+    _notes_sep = "zOtCiTeNoTeSeP"
+
+    def _convert_many_notes(self, notes):
+        """Convert a list of notes, yielding them in the same order"""
+
+        converted = [None] * len(notes)
+        if self._note_converter == "builtin":
+            for i, n in enumerate(notes):
+                try:
+                    converted[i] = html2markdown(n)
+                except UnsupportedHTML:
+                    pass
+        unsupported = [n for n, c in zip(notes, converted) if c is None]
+        if unsupported:
+            from_pandoc = self._pandoc_many_notes(unsupported)
+        for c in converted:
+            if c is None:
+                c = next(from_pandoc)
+            yield self._finish_notes(c)
+
+    def _pandoc_many_notes(self, notes):
+        """Convert a list of notes with a single pandoc process, yielding the
+        converted notes as soon as pandoc outputs them"""
+
+        p = self._pandoc()
+
+        def write():
+            for n in notes:
+                p.stdin.write((n + "<p>" + self._notes_sep + "</p>\n").encode("utf-8"))
+            p.stdin.close()
+
+        # Write in another thread to avoid a deadlock if pandoc fills its
+        # output pipe before reading all the input
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+        lines = []
+        for line in p.stdout:
+            line = line.decode()
+            if line.strip() == self._notes_sep:
+                yield "".join(lines).strip("\n") + "\n"
+                lines = []
+            else:
+                lines.append(line)
+        writer.join()
+        p.wait()
+
+    @_timed
+    def ExportNotes(self, keys, offset=0):
+        """Return a generator of the annotations and notes of many references,
+        read from the database at once and with a single pandoc process.
+
+        keys   (list): Zotero keys or citation keys.
+        offset  (int): Number added to the annotations' page numbers.
+
+        Each generated value is a tuple (key, annotations, notes), where the
+        annotations and the notes are as returned by GetAnnotations and
+        GetNotes.
+        """
+        cur = self._get_connection().cursor()
+        ids = [self._get_zotero_item_id(cur, k) for k in keys]
+        cur.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS zexport (itemID INTEGER PRIMARY KEY)"
+        )
+        cur.execute("DELETE FROM temp.zexport")
+        cur.executemany(
+            "INSERT OR IGNORE INTO temp.zexport VALUES (?)",
+            [(i,) for i in ids if i is not None],
+        )
+
+        annotations = {}
+        query = self._annotations_query(
+            "itemAttachments.parentItemID IN (SELECT itemID FROM temp.zexport)"
+        )
+        cur.execute(query)
+        for item_id, text, comment, page_label in cur.fetchall():
+            annotations.setdefault(item_id, []).append((text, comment, page_label))
+
+        notes = {}
+        query = self._notes_query(
+            "itemNotes.parentItemID IN (SELECT itemID FROM temp.zexport)"
+        )
+        cur.execute(query)
+        for item_id, item_note in cur.fetchall():
+            notes[item_id] = notes.get(item_id, "") + item_note
+
+        with_notes = [i for i in dict.fromkeys(ids) if i in notes]
+        converted = {}
+        if with_notes:
+            markdown = self._convert_many_notes(
+                [self._prepare_notes(notes[i]) for i in with_notes]
+            )
+        for key, item_id in zip(keys, ids):
+            # Notes are converted in the order of their first key
+            if item_id in notes and item_id not in converted:
+                for i, n in zip(with_notes[len(converted) :], markdown):
+                    converted[i] = n
+                    if i == item_id:
+                        break
+            yield (
+                key,
+                self._format_annotations(annotations.get(item_id, []), key, offset),
+                converted.get(item_id, ""),
+            )
+
     def Info(self):
         """Return information that might be useful for users of ZoteroEntries"""
 
+        self._use_reloaded_data()
         r = {
             "zotero.py": os.path.realpath(__file__),
             "data dir": self._dd,
@@ -667,6 +2149,19 @@ class ZoteroEntries:
             "better-bibtex.sqlite": self._b,
             "tmpdir": self._tmpdir,
             "references found": len(self._e.keys()),
+            "data generation": self._generation,
+            "watcher": type(self._watcher).__name__ if self._watcher else "off",
+            "full text index": self._tmpdir + "/zotcite_fts.sqlite",
             "docs": str(self._d) + "\n",
         }
+        if self._background:
+            if self._reloader is not None and self._reloader.is_alive():
+                r["background reload"] = "running"
+            else:
+                r["background reload"] = "idle"
+        if self._timings is not None:
+            lines = self._timings.report()
+            r["timings"] = "".join("\n    " + line for line in lines) + "\n"
+        if self._profile is not None:
+            r["profile"] = self._dump_profile()
         return r
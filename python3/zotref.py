@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""
+Pandoc JSON filter that resolves the citations inserted by zotcite and adds
+the CSL data of the cited references to the document's metadata, so that
+pandoc's citeproc does not need a bibliography file:
+
+    pandoc --filter /path/to/zotcite/python3/zotref.py --citeproc doc.md -o doc.pdf
+
+Citations written as @zotkey#citekey are replaced with the current citation
+key of the Zotero item, which is found by its Zotero key even if Better
+BibTeX changed its citation key. Citations written as @citekey are kept.
+
+With the --csl argument, the CSL JSON of the cited references is written
+instead of the document:
+
+    pandoc doc.md -t json | /path/to/zotcite/python3/zotref.py --csl > refs.json
+
+If zotcite_server.py is running, the references are requested from it.
+Otherwise, they are read from the Zotero database (or from zotcite's cache).
+"""
+
+import sys
+import json
+import socket
+
+from zotero import ZoteroEntries
+
+
+def _zotero():
+    """Return the client of a running zotcite_server.py or a ZoteroEntries"""
+    if hasattr(socket, "AF_UNIX"):
+        from zotcite_client import ZoteroClient, ZoteroServerError
+
+        try:
+            return ZoteroClient(start=False)
+        except ZoteroServerError:
+            pass
+    return ZoteroEntries()
+
+
+def _cites(node, found):
+    """Append to found the Cite elements in the pandoc AST node"""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if node.get("t") == "Cite":
+                found.append(node)
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+
+
+def _meta(value):
+    """Convert a JSON value into pandoc's metadata"""
+    if isinstance(value, dict):
+        return {"t": "MetaMap", "c": {k: _meta(v) for k, v in value.items()}}
+    if isinstance(value, list):
+        return {"t": "MetaList", "c": [_meta(v) for v in value]}
+    return {"t": "MetaString", "c": str(value)}
+
+
+def resolve(doc, zotero):
+    """Replace the citations of the pandoc document with the citation keys
+    of the Zotero items and return the CSL data of the cited references"""
+
+    cites = []
+    _cites(doc["blocks"], cites)
+    _cites(doc["meta"], cites)
+    keys = {c["citationId"] for cite in cites for c in cite["c"][0]}
+    csl = zotero.GetCSL(sorted(keys))
+
+    new = {}
+    for key, ref in csl.items():
+        if ref["id"] != key:
+            new[key] = ref["id"]
+    if new:
+        for cite in cites:
+            for c in cite["c"][0]:
+                c["citationId"] = new.get(c["citationId"], c["citationId"])
+            # The text of the citation, used if citeproc does not run
+            for inline in cite["c"][1]:
+                if inline.get("t") == "Str":
+                    for old in sorted(new, key=len, reverse=True):
+                        inline["c"] = inline["c"].replace("@" + old, "@" + new[old])
+
+    refs = {}
+    for ref in csl.values():
+        refs[ref["id"]] = ref
+    return list(refs.values())
+
+
+def main():
+    doc = json.load(sys.stdin)
+    refs = resolve(doc, _zotero())
+
+    if sys.argv[1:] == ["--csl"]:
+        json.dump(refs, sys.stdout, ensure_ascii=False, indent=1)
+        sys.stdout.write("\n")
+        return
+
+    # Keep the references already in the metadata
+    meta = doc["meta"]
+    old = meta.get("references", {"t": "MetaList", "c": []})
+    ids = set()
+    for ref in old["c"]:
+        rid = ref["c"].get("id", {}).get("c")
+        if isinstance(rid, list):
+            rid = "".join(i.get("c", "") for i in rid if i.get("t") == "Str")
+        ids.add(rid)
+    old["c"] += [_meta(ref) for ref in refs if ref["id"] not in ids]
+    if old["c"]:
+        meta["references"] = old
+    json.dump(doc, sys.stdout, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()